@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the MPI pipeline on synthetic data (no ERA5 or IBTrACS files needed).
+
+Times CAPE per sounding, pcmin per column, the MPI of a full basin tile and
+the IBTrACS extraction, and reports throughput (columns per second) and peak
+memory (tracemalloc). Results are saved as JSON in BENCHMARKS/, so runs of
+different commits can be compared with compare_results.
+
+    python benchmark_mpi.py --columns 2000 --ny 60 --nx 80
+    python benchmark_mpi.py --compare BENCHMARKS/old.json BENCHMARKS/new.json
+"""
+
+import numpy as np
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+import tempfile
+import tracemalloc
+import xarray as xr
+from cape import cape, cape_batch
+from pcmin_fullterm import pcmin, pcmin_columns, pcmin_field
+from pcmin_jit import HAS_NUMBA, pcmin_columns_jit
+from create_mpi_map import P_GRAD
+import preprocessing
+
+BENCH_DIR = 'BENCHMARKS'
+
+#%% SYNTHETIC DATA
+
+def synthetic_soundings(n, regime = 'tropical', seed = 0):
+    """
+    ERA5-like soundings on the 37 levels of P_GRAD
+    Input:
+        n: number of soundings
+        regime: 'tropical', 'extratropical' or 'mixed' (half of each)
+        seed: random seed
+    Output:
+        sst (C), psl (hPa): arrays (n,)
+        t (C), q (g/kg): arrays (n, 37)
+    """
+    rng = np.random.default_rng(seed)
+    if regime == 'mixed':
+        tropical = rng.random(n) < 0.5
+    else:
+        tropical = np.full(n, regime == 'tropical')
+
+    # surface temperature, lapse rate, tropopause height (km) and surface humidity
+    t0 = np.where(tropical, rng.uniform(24, 31, n), rng.uniform(5, 20, n))[:, None]
+    lapse = np.where(tropical, rng.uniform(5.5, 6.5, n), rng.uniform(6, 7.5, n))[:, None]
+    ztrop = np.where(tropical, rng.uniform(15, 17, n), rng.uniform(9, 12, n))[:, None]
+    q0 = np.where(tropical, rng.uniform(14, 20, n), rng.uniform(4, 10, n))[:, None]
+
+    z = -7.4 * np.log(P_GRAD / 1000.)
+    t = t0 - lapse * np.minimum(z, ztrop) + 2.0 * np.maximum(z - ztrop, 0) + rng.normal(0, 0.3, (n, P_GRAD.size))
+    q = q0 * np.exp(-z / 2.5)
+    q[:, P_GRAD < 100] = 0.
+    sst = t0[:, 0] + rng.uniform(-1, 2, n)
+    psl = rng.uniform(1005, 1018, n)
+    return(sst, psl, t, q)
+
+def synthetic_basin(ny, nx, seed = 0, land = 0.2):
+    """
+    Smooth basin fields, tropical in the south and extratropical in the north, with land (nan SST)
+    Output:
+        sst (C), mslp (hPa): arrays (ny, nx)
+        t (C), q (g/kg): arrays (37, ny, nx)
+    """
+    rng = np.random.default_rng(seed)
+    sst, psl, t, q = synthetic_soundings(ny * nx, 'tropical', seed)
+
+    # cool and dry towards the north, with smooth noise
+    north = np.repeat(np.linspace(0, 1, ny), nx)
+    noise = rng.normal(0, 1, (ny + 8, nx + 8))
+    kernel = np.ones(9) / 9
+    noise = np.apply_along_axis(np.convolve, 0, noise, kernel, 'valid')
+    noise = np.apply_along_axis(np.convolve, 1, noise, kernel, 'valid').ravel()
+    shift = -15 * north + 3 * noise
+    sst = 28 + shift + rng.normal(0, 0.2, ny * nx)
+    t = t - t[:, :1] + 27 + shift[:, None] * (P_GRAD > 200)
+    q = q * np.exp(0.07 * shift)[:, None]
+
+    sst[noise > np.quantile(noise, 1 - land)] = np.nan
+    return(sst.reshape(ny, nx), psl.reshape(ny, nx), np.moveaxis(t, 1, 0).reshape(-1, ny, nx),
+           np.moveaxis(q, 1, 0).reshape(-1, ny, nx))
+
+def synthetic_ibtracs(nstorms, ntime = 240, seed = 0):
+    """
+    Dataset with the IBTrACS variables used by preprocessing.extract_data (time in days since 17-11-1858)
+    """
+    rng = np.random.default_rng(seed)
+    shape = (nstorms, ntime)
+    lat = np.full(shape, np.nan, dtype=np.float32)
+    lon, wind, pres, rmw = lat.copy(), lat.copy(), lat.copy(), lat.copy()
+    time = np.full(shape, np.nan)
+    basin = np.full(shape, b'', dtype='S2')
+    nature = np.full(shape, b'', dtype='S2')
+    agency = np.full(shape, b'', dtype='S10')
+    codes = [b'EP', b'NA', b'NI', b'SI', b'SP', b'WP', b'SA']
+    agencies = [b'hurdat_atl', b'tokyo', b'newdelhi', b'bom', b'atcf', b'reunion']
+
+    for i in range(nstorms):
+        n = rng.integers(2, ntime)
+        steps = rng.choice([0.125, 0.125, 0.125, 0.0625], n - 1)
+        time[i, :n] = rng.integers(40000, 58000) + np.concatenate([[0], np.cumsum(steps)])
+        lat[i, :n] = rng.uniform(-35, 35) + np.cumsum(rng.normal(0, .3, n))
+        lon[i, :n] = rng.uniform(-180, 180) + np.cumsum(rng.normal(0, .3, n))
+        w = np.clip(20 + np.cumsum(rng.normal(0, 4, n)), 0, None) * rng.uniform(.5, 2.5)
+        w[rng.random(n) < .15] = np.nan
+        wind[i, :n] = np.round(w)
+        pres[i, :n] = np.where(rng.random(n) < .2, np.nan, 1010 - 0.8 * w)
+        rmw[i, :n] = np.where(rng.random(n) < .4, np.nan, rng.uniform(10, 80, n))
+        basin[i, :n] = codes[rng.integers(0, len(codes))]
+        nature[i, :n] = b'TS'
+        if rng.random() < .4:
+            nature[i, rng.integers(0, n):n] = b'ET'
+        agency[i, :n][~np.isnan(w)] = agencies[rng.integers(0, len(agencies))]
+
+    dims = ('storm', 'date_time')
+    return xr.Dataset({'basin': (dims, basin), 'season': ('storm', rng.integers(1980, 2021, nstorms)),
+                       'wmo_wind': (dims, wind), 'wmo_pres': (dims, pres), 'time': (dims, time),
+                       'lat': (dims, lat), 'lon': (dims, lon), 'usa_rmw': (dims, rmw),
+                       'wmo_agency': (dims, agency), 'nature': (dims, nature)})
+
+#%% TIMING
+
+def measure(fn, columns, repeat = 3):
+    """
+    Best wall-clock time of fn() over repeat runs, and its peak traced memory in a separate run
+    Output:
+        dict with seconds, columns, columns_per_second and peak_mb
+    """
+    seconds = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        seconds = min(seconds, time.perf_counter() - t0)
+
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'seconds': seconds, 'columns': int(columns), 'columns_per_second': columns / seconds,
+            'peak_mb': peak / 2**20}
+
+def run_benchmarks(columns = 2000, scalar = 100, ny = 60, nx = 80, storms = 2000, repeat = 3,
+                   only = ('cape', 'pcmin', 'tile', 'extract'), regime = 'mixed'):
+    """
+    Run the benchmarks
+    Input:
+        columns: number of soundings for the array versions
+        scalar: number of soundings for the scalar cape and pcmin (slow)
+        ny, nx: size of the basin tile
+        storms: number of synthetic IBTrACS storms
+        repeat: number of timed runs (the best is kept)
+        only: benchmarks to run
+        regime: soundings, see synthetic_soundings
+    Output:
+        results: dict {name: measure output}
+    """
+    results = {}
+    sst, psl, t, q = synthetic_soundings(columns, regime)
+    tk, r = t + 273.15, q * 1e-3
+
+    if 'cape' in only:
+        def cape_scalar():
+            for i in range(scalar):
+                cape(tk[i, 0], r[i, 0], P_GRAD[0], tk[i], r[i], P_GRAD, 0.0)
+        results['cape'] = measure(cape_scalar, scalar, repeat)
+        results['cape_batch'] = measure(lambda: cape_batch(tk[:, 0], r[:, 0], P_GRAD[0], tk, r, P_GRAD, 0.0), columns, repeat)
+
+    if 'pcmin' in only:
+        def pcmin_scalar():
+            for i in range(scalar):
+                pcmin(sst[i], psl[i], P_GRAD, t[i], q[i])
+        results['pcmin'] = measure(pcmin_scalar, scalar, repeat)
+        results['pcmin_columns'] = measure(lambda: pcmin_columns(sst, psl, P_GRAD, t, q), columns, repeat)
+        if HAS_NUMBA:
+            pcmin_columns_jit(sst[:2], psl[:2], P_GRAD, t[:2], q[:2])    # compile outside the timing
+            results['pcmin_columns_jit'] = measure(lambda: pcmin_columns_jit(sst, psl, P_GRAD, t, q), columns, repeat)
+
+    if 'tile' in only:
+        bsst, bpsl, bt, bq = synthetic_basin(ny, nx)
+        ocean = int(np.sum(np.isfinite(bsst)))
+        for backend in ('numpy', 'jit') if HAS_NUMBA else ('numpy',):
+            for stride in (0, 4):
+                results['tile_%s_stride%i' % (backend, stride)] = measure(
+                    lambda: pcmin_field(bsst, bpsl, P_GRAD, bt, bq, backend=backend, stride=stride), ocean, repeat)
+
+    if 'extract' in only:
+        data = synthetic_ibtracs(storms)
+        dir_path = preprocessing.dir_path
+        with tempfile.TemporaryDirectory() as tmp:
+            preprocessing.dir_path = tmp
+            try:
+                results['extract_data'] = measure(lambda: preprocessing.extract_data(data), storms, repeat)
+            finally:
+                preprocessing.dir_path = dir_path
+
+    return results
+
+#%% RESULTS
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+def save_results(results, config, path = None):
+    """
+    Save the results with the commit, machine and configuration as JSON, by default in BENCHMARKS/
+    """
+    report = {'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'machine': {'platform': platform.platform(), 'processor': platform.processor(),
+                          'cpus': os.cpu_count(), 'python': platform.python_version(),
+                          'numpy': np.__version__, 'numba': HAS_NUMBA},
+              'config': config, 'results': results}
+    if path is None:
+        os.makedirs(BENCH_DIR, exist_ok=True)
+        path = os.path.join(BENCH_DIR, 'benchmark_' + time.strftime('%Y%m%d_%H%M%S') + '_' + report['commit'] + '.json')
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1)
+    return path
+
+def print_results(results):
+    print("%-24s %10s %14s %10s" % ('benchmark', 'seconds', 'columns/s', 'peak MB'))
+    for name, res in results.items():
+        print("%-24s %10.4f %14.1f %10.1f" % (name, res['seconds'], res['columns_per_second'], res['peak_mb']))
+
+def compare_results(old_path, new_path):
+    """
+    Print the speedup (old time / new time) and memory ratio of the benchmarks in both files
+    """
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print("%s (%s) -> %s (%s)" % (old_path, old['commit'], new_path, new['commit']))
+    print("%-24s %10s %10s" % ('benchmark', 'speedup', 'memory'))
+    for name in old['results']:
+        if name in new['results']:
+            o, n = old['results'][name], new['results'][name]
+            print("%-24s %9.2fx %9.2fx" % (name, o['seconds'] / n['seconds'], n['peak_mb'] / max(o['peak_mb'], 1e-9)))
+
+#%%
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the MPI pipeline on synthetic data")
+    parser.add_argument('--columns', type=int, default=2000)
+    parser.add_argument('--scalar', type=int, default=100)
+    parser.add_argument('--ny', type=int, default=60)
+    parser.add_argument('--nx', type=int, default=80)
+    parser.add_argument('--storms', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--regime', default='mixed', choices=['tropical', 'extratropical', 'mixed'])
+    parser.add_argument('--only', nargs='+', default=['cape', 'pcmin', 'tile', 'extract'])
+    parser.add_argument('--out', default=None)
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_results(*args.compare)
+        sys.exit()
+
+    config = {k: v for k, v in vars(args).items() if k not in ('out', 'compare')}
+    results = run_benchmarks(args.columns, args.scalar, args.ny, args.nx, args.storms, args.repeat,
+                             args.only, args.regime)
+    print_results(results)
+    print("Saved to", save_results(results, config, args.out))
@@ -13,6 +13,7 @@
 #======-------------------------------------------------------------------
 #
 import numpy as np
+from moist_adiabat import adiabat_lookup
 #
 def cape(TP,RP,PP,T,R,P,SIG) :
    #
@@ -209,6 +210,259 @@ def cape(TP,RP,PP,T,R,P,SIG) :
       #
    return CAPED,TOB,IFLAG
    #
+#======-------------------------------------------------------------------
+#
+#     Column-batched version of cape. TP, RP and PP are arrays of parcel
+#       temperature (K), mixing ratio (gm/gm) and pressure (mb) of shape
+#       (ncol,), T and R are soundings of shape (ncol,nlev) and P is either
+#       a single pressure profile (nlev,) shared by all columns or an array
+#       of shape (ncol,nlev). All columns are lifted at once: the LCL test,
+#       the reversible-ascent Newton iteration (with a per-level convergence
+#       mask), the INB search and the PA/NA integration are array operations.
+#       Returns arrays CAPED, TOB and IFLAG of shape (ncol,) that match the
+#       scalar routine column by column.
+#
+#     Optional: LUT is a moist-adiabat table from moist_adiabat.load_table.
+#       The parcel temperature above the LCL is then looked up in the table
+#       and refined with undamped Newton steps until it changes less than
+#       TOL (K); with TOL=None the table value is used as it is. Levels
+#       outside the table use the iteration of cape. Without LUT, TOL is the
+#       convergence criterion of the iteration (0.001 in cape).
+#
+#     Optional: with NITER=True a fourth array of shape (ncol,) is returned,
+#       the number of Newton iterations of the column summed over its
+#       levels above the LCL (0 for rejected columns).
+#
+#======-------------------------------------------------------------------
+#
+def cape_batch(TP,RP,PP,T,R,P,SIG,LUT=None,TOL=0.001,NITER=False) :
+   #
+   #====== Change to float type arrays of shape (ncol,) and (ncol,nlev)
+   #
+   T=np.atleast_2d(np.asarray(T,dtype='float'))
+   R=np.atleast_2d(np.asarray(R,dtype='float'))
+   NCOL,NLEV=T.shape
+   TP=np.broadcast_to(np.asarray(TP,dtype='float'),(NCOL,))
+   RP=np.broadcast_to(np.asarray(RP,dtype='float'),(NCOL,))
+   PP=np.broadcast_to(np.asarray(PP,dtype='float'),(NCOL,))
+   P=np.broadcast_to(np.asarray(P,dtype='float'),(NCOL,NLEV))
+   LEV=np.arange(NLEV)
+   #
+   #====== Pressure below which sounding is ignored
+   ptop=59
+   #
+   ABOVE=P > ptop
+   N=np.where(np.any(ABOVE,axis=1),NLEV-1-np.argmax(ABOVE[:,::-1],axis=1),0)
+   INSND=LEV[None,:] <= N[:,None]
+   #
+   #====== Get minimum sounding level at or above PP 
+   #
+   BELOW=INSND & (P <= PP[:,None])
+   JMIN=np.argmax(BELOW,axis=1)
+   #
+   #====== Default values  
+   #
+   CAPED=np.zeros(NCOL)
+   TOB=T[:,0].copy()
+   IFLAG=np.ones(NCOL,dtype='int')
+   #
+   #====== Check that soundings are suitable
+   #
+   BAD=(RP < 1e-6) | (TP < 200) | ~np.any(BELOW,axis=1)
+   IFLAG[BAD]=0
+   CAPED[BAD]=np.nan
+   TOB[BAD]=np.nan
+   NCIT=np.zeros(NCOL,dtype='int')
+   #
+   OK=np.flatnonzero(~BAD)
+   if (OK.size == 0) :
+      return (CAPED,TOB,IFLAG,NCIT) if NITER else (CAPED,TOB,IFLAG)
+      #
+   TP=TP[OK]
+   RP=RP[OK]
+   PP=PP[OK]
+   T=T[OK]
+   R=R[OK]
+   P=P[OK]
+   N=N[OK]
+   JMIN=JMIN[OK]
+   INSND=INSND[OK]
+   NOK=OK.size
+   #
+   #====== Assign values of thermodynamic constants
+   #
+   CPD=1005.7
+   CPV=1870.0
+   CL=4190.0
+   CL=2500.0
+   CPVMCL=CPV-CL
+   RV=461.5
+   RD=287.04
+   EPS=RD/RV
+   ALV0=2.501e6
+   #
+   #====== Define various parcel quantities, including reversible 
+   #======                      entropy, S.                       
+   #
+   TPC=TP-273.15
+   ESP=6.112*np.exp(17.67*TPC/(243.5+TPC))
+   EVP=RP*PP/(EPS+RP)
+   RH=EVP/ESP
+   RH=np.where(RH > 1.0,1.0,RH)
+   ALV=ALV0+CPVMCL*TPC
+   S=(CPD+RP*CL)*np.log(TP)-RD*np.log(PP-EVP)+ALV*RP/TP-RP*RV*np.log(RH)
+   #
+   #====== Find lifted condensation pressure, PLCL 
+   #
+   CHI=TP/(1669.0-122.0*RH-TP)
+   PLCL=PP*(RH**CHI)
+   #
+   #====== Updraft levels, split at the lifted condensation level
+   #
+   UP=INSND & (LEV[None,:] >= JMIN[:,None])
+   DRY=UP & (P >= PLCL[:,None])
+   MOIST=UP & ~DRY
+   TVENV=T*(1.+R/EPS)/(1.+R)
+   TVRDIF=np.zeros((NOK,NLEV))
+   #
+   #====== Parcel quantities below lifted condensation level 
+   #
+   CI,LI=np.nonzero(DRY)
+   TG=TP[CI]*(P[CI,LI]/PP[CI])**(RD/CPD)
+   RG=RP[CI]
+   TLVR=TG*(1.+RG/EPS)/(1.+RG)
+   TVRDIF[CI,LI]=TLVR-TVENV[CI,LI]
+   #
+   #====== Parcel quantities above lifted condensation level, solved for
+   #======   every (column, level) pair at once. Elements drop out of the
+   #======   iteration as soon as their own temperature has converged.
+   #
+   CI,LI=np.nonzero(MOIST)
+   PJ=P[CI,LI]
+   SJ=S[CI]
+   RPJ=RP[CI]
+   TGNEW=T[CI,LI].copy()
+   TG=np.zeros(TGNEW.size)
+   RG=np.zeros(TGNEW.size)
+   FAIL=np.zeros(TGNEW.size,dtype='bool')
+   DAMP=np.ones(TGNEW.size,dtype='bool')
+   NIT=np.zeros(TGNEW.size,dtype='int')
+   #
+   #====== Start from the moist-adiabat table where it has a value
+   #
+   if LUT is not None :
+      TLUT=adiabat_lookup(SJ,PJ,RPJ,LUT)
+      HIT=np.isfinite(TLUT)
+      TGNEW[HIT]=TLUT[HIT]
+      DAMP[HIT]=False
+      if TOL is None :
+         TG[HIT]=TLUT[HIT]
+         TC=TG[HIT]-273.15
+         ENEW=6.112*np.exp(17.67*TC/(243.5+TC))
+         RG[HIT]=EPS*ENEW/(PJ[HIT]-ENEW)
+         #
+   TOLJ=0.001 if TOL is None else TOL
+   ACT=np.abs(TGNEW-TG) > TOLJ
+   NC=0
+   #
+   while np.any(ACT) :
+      #
+      A=np.flatnonzero(ACT)
+      TG[A]=TGNEW[A]
+      TC=TG[A]-273.15
+      ENEW=6.112*np.exp(17.67*TC/(243.5+TC))
+      RG[A]=EPS*ENEW/(PJ[A]-ENEW)
+      #
+      NC=NC+1
+      NIT[A]=NIT[A]+1
+      #
+      #====== Calculate estimates of the rates of change of the entropy  
+      #====== with temperature at constant pressure    
+      #
+      ALV=ALV0+CPVMCL*(TG[A]-273.15)
+      SL=(CPD+RPJ[A]*CL+ALV*ALV*RG[A]/(RV*TG[A]*TG[A]))/TG[A]
+      EM=RG[A]*PJ[A]/(EPS+RG[A])
+      SG=(CPD+RPJ[A]*CL)*np.log(TG[A])-RD*np.log(PJ[A]-EM)+ALV*RG[A]/TG[A]
+      #
+      if (NC < 3) :
+         AP=np.where(DAMP[A],0.3,1.0)
+      else :
+         AP=1.0
+         #
+      TGNEW[A]=TG[A]+AP*(SJ[A]-SG)/SL
+      ACT[A]=np.abs(TGNEW[A]-TG[A]) > TOLJ
+      #
+      #------ Bail out if things get out of hand 
+      #
+      FAIL[A]=FAIL[A] | (NC > 500) | (ENEW > (PJ[A]-1))
+      if (NC > 500) :
+         break
+         #
+   #------ Calculate buoyancy 
+   #
+   RMEAN=SIG*RG+(1-SIG)*RPJ
+   TLVR=TG*(1.+RG/EPS)/(1.+RMEAN)
+   TVRDIF[CI,LI]=TLVR-TVENV[CI,LI]
+   IFLAG[OK[np.unique(CI[FAIL])]]=2
+   NCIT[OK]=np.bincount(CI,weights=NIT,minlength=NOK).astype('int')
+   #
+   #====== Find maximum level of positive buoyancy, INB 
+   #
+   POS=UP & (TVRDIF > 0)
+   INB=np.where(np.any(POS,axis=1),NLEV-1-np.argmax(POS[:,::-1],axis=1),1)
+   INB=np.maximum(INB,1)
+   #
+   #====== Find positive and negative areas and CAPE where INB lies
+   #======   above the first level and above JMIN
+   #
+   DO=np.flatnonzero((INB != JMIN) & (INB > 1))
+   if (DO.size == 0) :
+      return (CAPED,TOB,IFLAG,NCIT) if NITER else (CAPED,TOB,IFLAG)
+      #
+   TVRDIF=TVRDIF[DO]
+   T=T[DO]
+   P=P[DO]
+   PP=PP[DO]
+   N=N[DO]
+   JMIN=JMIN[DO]
+   INB=INB[DO]
+   ROW=np.arange(DO.size)
+   #
+   PFAC=RD*(TVRDIF[:,1:]+TVRDIF[:,:-1])*(P[:,:-1]-P[:,1:])/(P[:,1:]+P[:,:-1])
+   LAYER=(LEV[None,1:] >= JMIN[:,None]+1) & (LEV[None,1:] <= INB[:,None])
+   PA=np.cumsum(np.where(LAYER & (PFAC > 0.0),PFAC,0.0),axis=1)[:,-1]
+   NA=np.cumsum(np.where(LAYER & (PFAC < 0.0),-PFAC,0.0),axis=1)[:,-1]
+   #
+   #====== Find area between parcel pressure and first level above it
+   #
+   PJMIN=P[ROW,JMIN]
+   TVJMIN=TVRDIF[ROW,JMIN]
+   PMA=(PP+PJMIN) 
+   PFAC=RD*(PP-PJMIN)/PMA
+   PA=PA+PFAC*np.where(0.0 > TVJMIN,0.0,TVJMIN)
+   NA=NA-PFAC*np.where(0.0 < TVJMIN,0.0,TVJMIN)
+   #
+   #====== Find residual positive area above INB and TO 
+   #
+   PAT=np.zeros(DO.size)
+   TOBD=T[ROW,INB]
+   TOP=np.flatnonzero(INB < N)
+   if (TOP.size > 0) :
+      I0=INB[TOP]
+      I1=I0+1
+      R0=ROW[TOP]
+      PINB=(P[R0,I1]*TVRDIF[R0,I0]-P[R0,I0]*TVRDIF[R0,I1])/(TVRDIF[R0,I0]-TVRDIF[R0,I1])
+      PAT[TOP]=RD*TVRDIF[R0,I0]*(P[R0,I0]-PINB)/(P[R0,I0]+PINB)
+      TOBD[TOP]=(T[R0,I0]*(PINB-P[R0,I1])+T[R0,I1]*(P[R0,I0]-PINB))/(P[R0,I0]-P[R0,I1])
+      #
+   #====== Find CAPE
+   #
+   CAPEB=PA+PAT-NA
+   CAPED[OK[DO]]=np.where(0.0 > CAPEB,0.0,CAPEB)
+   TOB[OK[DO]]=TOBD
+   #
+   return (CAPED,TOB,IFLAG,NCIT) if NITER else (CAPED,TOB,IFLAG)
+   #
 #TP  = 26.0+273.15
 #RP  = 17.6*1e-3
 #PP  = 1000
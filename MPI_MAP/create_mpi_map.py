@@ -6,9 +6,20 @@ Created on Tue Mar  1 17:15:11 2022
 @author: shiweiyuan
 """
 
-from pcmin_fullterm import pcmin
+from pcmin_fullterm import pcmin, pcmin_field
+from pcmin_jit import HAS_NUMBA
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import partial
+from multiprocessing import shared_memory, get_context
 import numpy as np
+import os
 import preprocessing
+from import_fields import read_level_field
+from era5_fields import era5_box
+from field_cache import cached_box
+import mpi_manifest
+import mpi_report
+from mpi_report import stage
 from tqdm import tqdm
 import matplotlib.pyplot as plt
 
@@ -36,113 +47,591 @@ def MPI_gridpoint(sst, mslp, p_grad, t_grad, q_grad):
     #CAPEA = tmf[8]
     return(PMIN)
 
-def MPI_map(idx, months_override = []):
-    
-    p_grad = np.array([1000, 975, 950, 925, 900, 875, 850, 825, 800,
-                       775, 750, 700, 650, 600, 550, 500, 450, 400,
-                       350, 300, 250, 225, 200, 175, 150, 125, 100,
-                       70, 50, 30, 20, 10, 7, 5, 3, 2, 1])
-    
-    months = np.array([[6,7,8,9,10,11],[6,7,8,9,10,11],[4,5,6,9,10,11],[1,2,3,4,11,12],[1,2,3,4,11,12],[5,6,7,8,9,10,11]])
-    
+P_GRAD = np.array([1000, 975, 950, 925, 900, 875, 850, 825, 800,
+                   775, 750, 700, 650, 600, 550, 500, 450, 400,
+                   350, 300, 250, 225, 200, 175, 150, 125, 100,
+                   70, 50, 30, 20, 10, 7, 5, 3, 2, 1])
+
+MPI_MONTHS = [[6,7,8,9,10,11],[6,7,8,9,10,11],[4,5,6,9,10,11],[1,2,3,4,11,12],[1,2,3,4,11,12],[5,6,7,8,9,10,11]]
+
+MPI_YEARS = range(2008, 2018)
+
+WARM_STARTS = (None, 'neighbour', 'prior')
+
+def check_warm_start(warm_start):
+    if warm_start not in WARM_STARTS:
+        raise ValueError("warm_start must be None, 'neighbour' or 'prior', not " + repr(warm_start))
+
+def basin_slices(idx):
+    # grid indices of the basin box on the flipped (south to north) 0.25 deg ERA5 grid;
+    # for a tuple of basin indices the box around all of them (see MPI_map_global)
+    if isinstance(idx, tuple):
+        boxes = np.array([basin_slices(i) for i in idx])
+        return boxes[:,0].min(), boxes[:,1].max(), boxes[:,2].min(), boxes[:,3].max()
     lat0,lat1,lon0,lon1 = preprocessing.BOUNDARIES_BASINS(idx)
     lat0 = (lat0 + 90) * 4
     lat1 = (lat1 + 90) * 4
     lon0 *= 4
     lon1 *= 4
+    return lat0,lat1,lon0,lon1
+
+def load_basin_sst(idx, m, y, source = 'text'):
+    # returns the sst (C) of the basin for month m, year y, source as for load_basin_fields
     
-    mpi_months = months[idx]
+    lat0,lat1,lon0,lon1 = basin_slices(idx)
     
-    if len(months_override) > 0:
-        mpi_months = months_override
+    if source == 'cache':
+        return cached_box('sst', m, y, lat0, lat1, lon0, lon1)
+    if source == 'era5':
+        return era5_box('sst', m, y, lat0, lat1, lon0, lon1) - 273.15
     
-    for m in mpi_months:
-        for y in range(2008, 2018):
-            sst_globe = np.flip(np.loadtxt('SST_FIELDS/SST_month'+str(m)+'_year'+str(y)+'.txt'), 0)
-            sst_basin = sst_globe[lat0:lat1, lon0:lon1]
-            # plt.title("SST MAP")
-            # plt.pcolormesh(sst_basin)
-            # plt.show()
-            
-            np.savetxt("sst_basin_test.txt", sst_basin)
-            
+    sst_globe = np.flip(np.loadtxt('SST_FIELDS/SST_month'+str(m)+'_year'+str(y)+'.txt'), 0)
+    sst_basin = sst_globe[lat0:lat1, lon0:lon1]
+    # plt.title("SST MAP")
+    # plt.pcolormesh(sst_basin)
+    # plt.show()
+    return sst_basin - 273.15
+
+def load_basin_fields(idx, m, y, source = 'text', timers = None):
+    # returns sst (C), mslp (hPa), t (C) and q (g/kg) of the basin for month m, year y
+    # formats:
+    # sst, mslp: (lat, lon)
+    # t, q: (level, lat, lon)
+    # source: 'text' reads T and Q from the per-level text files,
+    #         'store' from the chunked stores written by import_fields,
+    #         'era5' reads the basin box of all fields straight from the ERA5 NetCDF files,
+    #         'cache' takes views of the memory-mapped fields of field_cache (already in these units)
+    # timers: optional dict, the seconds spent reading ('load') and converting units
+    #         ('convert') are added to it (see mpi_report)
+    
+    lat0,lat1,lon0,lon1 = basin_slices(idx)
+    
+    with stage(timers, 'load'):
+        sst_basin = load_basin_sst(idx, m, y, source)
+        
+        if source == 'cache':
+            return (sst_basin,) + tuple(cached_box(var, m, y, lat0, lat1, lon0, lon1) for var in ('mslp', 't', 'q'))
+        
+        if source == 'era5':
+            mslp_basin = era5_box('mslp', m, y, lat0, lat1, lon0, lon1)
+            t_grads = era5_box('t', m, y, lat0, lat1, lon0, lon1)
+            q_grads = era5_box('q', m, y, lat0, lat1, lon0, lon1)
+        else:
             mslp_globe = np.flip(np.loadtxt('MSLP_FIELDS/MSLP_month'+str(m)+'_year'+str(y)+'.txt'), 0)
             mslp_basin = mslp_globe[lat0:lat1, lon0:lon1]
             # plt.title("MSLP MAP")
             # plt.pcolormesh(mslp_basin)
             # plt.show()
-            
-            t_grads = np.zeros((len(p_grad), lat1-lat0, lon1-lon0))
-            q_grads = np.zeros((len(p_grad), lat1-lat0, lon1-lon0))
+        
+        if source == 'store':
+            t_grads = read_level_field('t', m, y, lat0, lat1, lon0, lon1)
+            q_grads = read_level_field('q', m, y, lat0, lat1, lon0, lon1)
+        elif source == 'text':
+            t_grads = np.zeros((len(P_GRAD), lat1-lat0, lon1-lon0))
+            q_grads = np.zeros((len(P_GRAD), lat1-lat0, lon1-lon0))
             
             print("Loading in T values")
-            for level in tqdm(range(len(p_grad))):
+            for level in tqdm(range(len(P_GRAD))):
                 tgrad_map_level = np.flip(np.loadtxt("T_FIELDS/T_month"+str(m)+"_year"+str(y)+"_level"+str(level)+".txt"),1)[lat0:lat1, lon0:lon1]
                 t_grads[level,:,:] = tgrad_map_level
-                #print("t_grad level %i loaded" % level)
-            
-            #plt.title("T Level 0")
-            #plt.pcolormesh(t_grads[0])
-            #plt.show()
             
             print("Loading in Q values")
-            for level in tqdm(range(len(p_grad))):
+            for level in tqdm(range(len(P_GRAD))):
                 qgrad_map_level = np.flip(np.loadtxt("Q_FIELDS/Q_month"+str(m)+"_year"+str(y)+"_level"+str(level)+".txt"),1)[lat0:lat1, lon0:lon1]
                 q_grads[level,:,:] = qgrad_map_level
-                #print("q_grad level %i loaded" % level)
-            
-            #plt.title("SH Level 0")
-            #plt.pcolormesh(q_grads[0])
-            #plt.show()
-            
-            ########### SET TO CORRECT UNITS
-            
-            mslp_basin = mslp_basin / 1e2
-            sst_basin = sst_basin - 273.15
-            t_grads = t_grads - 273.15
-            q_grads = q_grads * 1e3
+    
+    ########### SET TO CORRECT UNITS
+    
+    with stage(timers, 'convert'):
+        mslp_basin = mslp_basin / 1e2
+        t_grads = t_grads - 273.15
+        q_grads = q_grads * 1e3
+    
+    return(sst_basin, mslp_basin, t_grads, q_grads)
+
+def ocean_index_path(idx, source = 'text'):
+    return "MPI_MAPS/OCEAN_INDEX_BASIN" + str(idx) + "_" + source + ".npz"
+
+def ocean_index(idx, source = 'text', m = None, y = None):
+    # flat indices of the ocean points (finite sst) of the basin box. The land mask
+    # does not change with time, so the index is built once from month m, year y (the
+    # first unit of the run, by default the first of MPI_MONTHS and MPI_YEARS) and
+    # saved to MPI_MAPS for all later months, years and runs.
+    # The file is per source and keeps the box it was built for, the index is rebuilt
+    # when the basin boundaries change
+    
+    path = ocean_index_path(idx, source)
+    box = np.array(basin_slices(idx))
+    if os.path.exists(path):
+        with np.load(path) as saved:
+            if np.array_equal(saved['box'], box):
+                return saved['index']
+    
+    if m is None:
+        m, y = MPI_MONTHS[idx][0], MPI_YEARS[0]
+    sst_basin = load_basin_sst(idx, m, y, source)
+    index = np.flatnonzero(np.isfinite(np.asarray(sst_basin).ravel()))
+    # several jobs of the same basin may build the index at the same time
+    mpi_manifest.replace_atomic(lambda tmp: np.savez(tmp, index=index, box=box), path)
+    return index
+
+def pending_units(idx, mpi_months, source, manifest, resume, years = MPI_YEARS):
+    # the (month, year) units still to compute, in order, and the input hash of every unit;
+    # the units to compute are registered as pending in the manifest
+    units = []
+    inputs = {}
+    for m in mpi_months:
+        for y in years:
+            inputs[(m,y)] = mpi_manifest.input_hash(m, y, source)
+            if resume and mpi_manifest.is_done(manifest, mpi_manifest.unit_key(idx, m, y), inputs[(m,y)],
+                                               mpi_manifest.map_path(idx, m, y)):
+                print("Month %i, Year %i MPI MAP already done." % (m,y))
+                continue
+            units.append((m,y))
+    mpi_manifest.mark_units(idx, manifest, {mpi_manifest.unit_key(idx, m, y): inputs[(m,y)] for m, y in units}, 'pending')
+    return units, inputs
+
+def load_units(idx, units, source = 'text', timers = None, prefetch = True):
+    # yields m, y and the basin fields of every unit in units. With prefetch the fields
+    # of the next unit are loaded (read, flipped, sliced and converted) on a background
+    # thread while the current one is computed, so at most two units are in memory
+    # timers: None or a dict of timer dicts per unit, see load_basin_fields; the time the
+    #         caller waits for the fields is added as 'wait'
+    
+    def load(m, y):
+        return load_basin_fields(idx, m, y, source, None if timers is None else timers[(m,y)])
+    
+    if not prefetch:
+        for m, y in units:
+            yield m, y, load(m, y)
+        return
+    
+    with ThreadPoolExecutor(max_workers=1) as loader:
+        future = loader.submit(load, *units[0]) if units else None
+        for k, (m, y) in enumerate(units):
+            with stage(None if timers is None else timers[(m,y)], 'wait'):
+                fields = future.result()
+            future = loader.submit(load, *units[k+1]) if k+1 < len(units) else None
+            yield m, y, fields
+            del fields
+
+def write_unit(idx, m, y, mpi_map_month, stats = None, timers = None, pm = None):
+    # writes the map (and the iteration and IFL maps, and the iterated pressures) of a
+    # unit, called on the writer thread
+    with stage(timers, 'write'):
+        mpi_manifest.save_map(mpi_manifest.map_path(idx, m, y), mpi_map_month)
+        if stats is not None:
+            mpi_report.save_stats(idx, m, y, *stats)
+        if pm is not None:
+            mpi_manifest.replace_atomic(lambda tmp: np.save(tmp, pm), mpi_manifest.pm_path(idx, m, y))
+
+def prior_pm(idx, m, y, source, manifest):
+    # iterated pressures of the same month of the previous year saved by an earlier run
+    # (warm_start = 'prior'), or None when that year is not done for its current inputs
+    key = mpi_manifest.unit_key(idx, m, y-1)
+    path = mpi_manifest.pm_path(idx, m, y-1)
+    if mpi_manifest.is_done(manifest, key, mpi_manifest.input_hash(m, y-1, source), path):
+        return np.load(path)
+    return None
+
+def write_and_complete(write, complete):
+    # runs on the writer thread, so that a unit is marked done in the manifest as soon as
+    # its files are written and not only after the next unit has been computed
+    write()
+    complete()
+
+def finish_writes(pending, wait = False):
+    # collects the asynchronous writes that have finished (all of them with wait), in the
+    # order they were submitted; a failed write raises here
+    while pending and (wait or pending[0].done()):
+        pending.pop(0).result()
+
+def MPI_map(idx, months_override = [], source = 'text', warm_start = None, stride = 4,
+            resume = True, checkpoint_rows = None, report = False, prefetch = True, years_override = [],
+            lut = None, tol = 0.001):
+    # warm_start: None starts the pcmin iteration of every point from 970 hPa,
+    #             'neighbour' first computes every stride-th row and column and starts
+    #             the other points from those results,
+    #             'prior' starts from the same month of the previous year (and from
+    #             neighbours in the first year); the iterated pressures are saved with
+    #             the maps, so a resumed run starts from those of the previous year too
+    # resume: skip the months/years marked done in the basin manifest (see mpi_manifest)
+    #         whose inputs have not changed, and continue from row checkpoints
+    # checkpoint_rows: compute the map in blocks of this many latitude rows and save a
+    #                  checkpoint after every block (for the largest basins)
+    # report: also save maps of the pcmin and CAPE iterations and of IFL, and a run
+    #         report with stage timers and convergence summary per month/year (see mpi_report)
+    # prefetch: load the fields of the next month/year while the current one is computed
+    #           and write finished maps on a background thread (see load_units); a unit
+    #           is marked done in the manifest once its map is written
+    # years_override: compute these years instead of MPI_YEARS (e.g. one year per job,
+    #                 see mpi_scheduler)
+    # lut, tol: moist-adiabat table (moist_adiabat.load_table()) and tolerance for CAPE,
+    #           see pcmin_field (computed with the numpy engine)
+    # returns the total number of pcmin iterations per (month, year)
+    
+    check_warm_start(warm_start)
+    p_grad = P_GRAD
+    
+    mpi_months = MPI_MONTHS[idx]
+    mpi_years = MPI_YEARS
+    
+    if len(months_override) > 0:
+        mpi_months = months_override
+    if len(years_override) > 0:
+        mpi_years = years_override
+    
+    iterations = {}
+    manifest = mpi_manifest.load_manifest(idx)
+    units, inputs = pending_units(idx, mpi_months, source, manifest, resume, mpi_years)
+    if len(units) == 0:
+        return iterations
+    index = ocean_index(idx, source, *units[0])
+    timers = {unit: {} for unit in units} if report else None
+    pm_prior = None
+    last = None
+    pending = []
+    
+    def complete(m, y, checkpoint, row, stats):
+        key = mpi_manifest.unit_key(idx, m, y)
+        mpi_manifest.mark_unit(idx, manifest, key, 'done', inputs[(m,y)], iterations=iterations[(m,y)])
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        print("Month %i, Year %i MPI MAP done, %.2f pcmin iterations per point." % (m,y,iterations[(m,y)]/max(index.size,1)))
+        if report:
+            summary = mpi_report.convergence_summary(idx, index, *stats)
+            mpi_report.print_report(mpi_report.save_report(idx, m, y, timers[(m,y)], summary, source=source,
+                                                           warm_start=warm_start, resumed_row=row))
+    
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        for m, y, fields in load_units(idx, units, source, timers, prefetch):
+            key = mpi_manifest.unit_key(idx, m, y)
+            checkpoint = mpi_manifest.checkpoint_path(idx, m, y)
+            unit_timers = None if timers is None else timers[(m,y)]
+            mpi_manifest.mark_unit(idx, manifest, key, 'running', inputs[(m,y)])
             
-            ###########
+            sst_basin, mslp_basin, t_grads, q_grads = fields
+            ny, nx = sst_basin.shape
+            # the previous year's pressures, from this run or saved with its map
+            pm0 = pm_prior if last == (m,y-1) else None
+            if pm0 is None and warm_start == 'prior':
+                pm0 = prior_pm(idx, m, y, source, manifest)
             
-            mpi_map_month = np.zeros(sst_basin.shape)
+            mpi_map_month = np.full((ny,nx), np.nan)
+            pm_month = np.full((ny,nx), np.nan)
+            niter = np.zeros((ny,nx))
+            ncape = np.zeros((ny,nx))
+            ifl = np.zeros((ny,nx))
+            row = 0
+            saved = mpi_manifest.load_checkpoint(checkpoint, inputs[(m,y)]) if resume and checkpoint_rows else None
+            if saved is not None:
+                mpi_map_month, pm_month, niter, row = saved['mpi'], saved['pm'], saved['niter'], int(saved['row'])
+                ncape, ifl = saved.get('ncape', ncape), saved.get('ifl', ifl)
+                print("Resuming from checkpoint at row %i" % row)
             
             print("Calculating MPI Field, Month %i, Year %i" % (m,y))
-            for lat in tqdm(range(sst_basin.shape[0])):
-                for lon in range(sst_basin.shape[1]):
-                    
-                    t_grad = t_grads[:,lat,lon]
-                    q_grad = q_grads[:,lat,lon]
-                    sst = sst_basin[lat,lon]
-                    mslp = mslp_basin[lat,lon]
-                    """
-                    if sst<-1000.: # LAND
-                        mpi_map_month[lat,lon] = np.nan
-                    else: # OCEAN
-                        tmp = pcmin(sst, mslp, p_grad, t_grad, q_grad)
-                        if ~np.isnan(tmp[0]) and tmp[0]!=0:
-                            mpi_map_month[lat,lon] = tmp[0]
-                        else:
-                            mpi_map_month[lat,lon] = np.nan
-                    """
-                    if np.isnan(sst) == True:
-                        #print("SST is nan")
-                        mpi_map_month[lat,lon] = np.nan
-                        continue
-                    # COMMENT PRINTS OUT FOR SPEED
-                    #print("tgrad: ", t_grad)
-                    #print("qgrad: ", q_grad)
-                    #print("sst: ", sst)
-                    #print("mslp: ", mslp)
-                    
-                    mpi = MPI_gridpoint(sst, mslp, p_grad, t_grad, q_grad)
-                    #print("mpi: ", mpi)
-                    mpi_map_month[lat, lon] = mpi
-                    
-                    #print("MPI Calc. lat %i lon %i calculated" % (lat, lon))
+            # all ocean points of a block of rows are iterated together, land stays nan
+            block = checkpoint_rows or ny
+            for r0 in range(row, ny, block):
+                r1 = min(r0+block, ny)
+                i0, i1 = np.searchsorted(index, [r0*nx, r1*nx])
+                with stage(unit_timers, 'compute'):
+                    tmf = pcmin_field(sst_basin[r0:r1], mslp_basin[r0:r1], p_grad, t_grads[:,r0:r1], q_grads[:,r0:r1],
+                                      index=index[i0:i1] - r0*nx, pm0=None if pm0 is None else pm0[r0:r1],
+                                      stride=stride if warm_start else 0, stats=report, lut=lut, tol=tol)
+                mpi_map_month[r0:r1], pm_month[r0:r1], niter[r0:r1], ifl[r0:r1] = tmf[0], tmf[9], tmf[10], tmf[3]
+                if report:
+                    ncape[r0:r1] = tmf[11]
+                if checkpoint_rows and r1 < ny:
+                    mpi_manifest.save_checkpoint(checkpoint, inputs[(m,y)], r1, mpi=mpi_map_month, pm=pm_month, niter=niter,
+                                                 ncape=ncape, ifl=ifl)
+            del fields, sst_basin, mslp_basin, t_grads, q_grads
+            
+            last = (m,y)
+            pm_prior = pm_month if warm_start == 'prior' else None
+            iterations[(m,y)] = int(niter.sum())
             
-            np.savetxt("MPI_MAPS/MPI_MAP_BASIN" +str(idx)+ "_MONTH" +str(m)+"_YEAR"+str(y)+".txt", mpi_map_month)
-            print("Month %i, Year %i MPI MAP done." % (m,y))
+            stats = (niter, ncape, ifl) if report else None
+            pending.append(writer.submit(write_and_complete,
+                                         partial(write_unit, idx, m, y, mpi_map_month, stats, unit_timers, pm_prior),
+                                         partial(complete, m, y, checkpoint, row, stats)))
+            finish_writes(pending, wait=not prefetch)
+        finish_writes(pending, wait=True)
+    
+    return iterations
+
+#%% PARALLEL DRIVER
+
+# The basin fields of one month/year are put in shared memory once; every
+# worker attaches to the blocks and only reads the ocean points of its own
+# tile of latitude rows.
+
+_FIELDS = ('sst', 'mslp', 't', 'q', 'mpi', 'pm', 'niter', 'ncape', 'ifl', 'index')
+
+_WORKER_LUT = None
+
+def _init_worker(lut = None):
+    # one thread per worker process, the pool provides the parallelism; the
+    # moist-adiabat table is sent to every worker once
+    global _WORKER_LUT
+    _WORKER_LUT = lut
+    if HAS_NUMBA:
+        import numba
+        numba.set_num_threads(1)
+
+def _attach(names, shapes):
+    blocks = {k: shared_memory.SharedMemory(name=names[k]) for k in _FIELDS}
+    arrays = {k: np.ndarray(shapes[k], dtype=np.int64 if k == 'index' else np.float64, buffer=blocks[k].buf) for k in _FIELDS}
+    return blocks, arrays
+
+def _mpi_tile(names, shapes, row0, row1, i0, i1, backend, warm_start, stride, stats = False, tol = 0.001):
+    # 'pm' holds the previous year's iterated pressure on input (warm_start = 'prior')
+    # and this year's on output
+    blocks, a = _attach(names, shapes)
+    try:
+        nx = shapes['sst'][1]
+        tmf = pcmin_field(a['sst'][row0:row1], a['mslp'][row0:row1], P_GRAD,
+                          a['t'][:,row0:row1], a['q'][:,row0:row1], backend=backend,
+                          index=a['index'][i0:i1] - row0*nx,
+                          pm0=a['pm'][row0:row1] if warm_start == 'prior' else None,
+                          stride=stride if warm_start else 0, stats=stats, lut=_WORKER_LUT, tol=tol)
+        a['mpi'][row0:row1] = tmf[0]
+        a['pm'][row0:row1] = tmf[9]
+        a['niter'][row0:row1] = tmf[10]
+        a['ifl'][row0:row1] = tmf[3]
+        if stats:
+            a['ncape'][row0:row1] = tmf[11]
+    finally:
+        del a
+        for block in blocks.values():
+            block.close()
+    return row1 - row0
+
+def MPI_map_parallel(idx, months_override = [], workers = None, chunk_rows = 8, backend = 'auto', source = 'text',
+                     warm_start = None, stride = 4, resume = True, report = False, prefetch = True,
+                     lut = None, tol = 0.001):
+    # MPI_map on a process pool: every month/year map is split into tiles of
+    # chunk_rows latitude rows, computed by `workers` processes (default: all cores).
+    # warm_start, stride, resume, report, prefetch, lut and tol as for MPI_map
+    # (neighbours are taken within a tile)
+    
+    check_warm_start(warm_start)
+    if lut is not None and backend == 'jit':
+        raise ValueError("the moist-adiabat table (lut) needs backend 'numpy' or 'auto'")
+    mpi_months = MPI_MONTHS[idx]
+    
+    if len(months_override) > 0:
+        mpi_months = months_override
+    
+    iterations = {}
+    manifest = mpi_manifest.load_manifest(idx)
+    units, inputs = pending_units(idx, mpi_months, source, manifest, resume, MPI_YEARS)
+    if len(units) == 0:
+        return iterations
+    
+    lat0,lat1,lon0,lon1 = basin_slices(idx)
+    ny, nx = lat1-lat0, lon1-lon0
+    index = ocean_index(idx, source, *units[0])
+    shapes = {'sst': (ny,nx), 'mslp': (ny,nx), 't': (len(P_GRAD),ny,nx), 'q': (len(P_GRAD),ny,nx), 'mpi': (ny,nx),
+              'pm': (ny,nx), 'niter': (ny,nx), 'ncape': (ny,nx), 'ifl': (ny,nx), 'index': index.shape}
+    blocks = {k: shared_memory.SharedMemory(create=True, size=max(8*int(np.prod(shapes[k])), 1)) for k in _FIELDS}
+    names = {k: blocks[k].name for k in _FIELDS}
+    shared = {k: np.ndarray(shapes[k], dtype=np.int64 if k == 'index' else np.float64, buffer=blocks[k].buf) for k in _FIELDS}
+    shared['index'][:] = index
+    
+    # tiles of latitude rows with the range of their ocean points in index; all-land tiles are skipped
+    tiles = [(r, min(r+chunk_rows, ny)) for r in range(0, ny, chunk_rows)]
+    tiles = [(r0, r1) + tuple(np.searchsorted(index, [r0*nx, r1*nx])) for r0, r1 in tiles]
+    tiles = [tile for tile in tiles if tile[3] > tile[2]]
+    timers = {unit: {} for unit in units} if report else None
+    last = None
+    pending = []
+    
+    def complete(m, y, stats):
+        mpi_manifest.mark_unit(idx, manifest, mpi_manifest.unit_key(idx, m, y), 'done', inputs[(m,y)], iterations=iterations[(m,y)])
+        print("Month %i, Year %i MPI MAP done, %.2f pcmin iterations per point." % (m,y,iterations[(m,y)]/max(index.size,1)))
+        if report:
+            summary = mpi_report.convergence_summary(idx, index, *stats)
+            mpi_report.print_report(mpi_report.save_report(idx, m, y, timers[(m,y)], summary, source=source,
+                                                           warm_start=warm_start, workers=workers))
+    
+    try:
+        # spawned workers: forking a process that already runs numba threads is not safe
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn'), initializer=_init_worker,
+                                 initargs=(lut,)) as pool, \
+             ThreadPoolExecutor(max_workers=1) as writer:
+            for m, y, fields in load_units(idx, units, source, timers, prefetch):
+                unit_timers = None if timers is None else timers[(m,y)]
+                mpi_manifest.mark_unit(idx, manifest, mpi_manifest.unit_key(idx, m, y), 'running', inputs[(m,y)])
+                
+                # the previous year's pressures, from this run or saved with its map
+                if last != (m,y-1):
+                    pm0 = prior_pm(idx, m, y, source, manifest) if warm_start == 'prior' else None
+                    shared['pm'][:] = np.nan if pm0 is None else pm0
+                with stage(unit_timers, 'load'):
+                    shared['sst'][:], shared['mslp'][:], shared['t'][:], shared['q'][:] = fields
+                del fields
+                shared['mpi'][:] = np.nan
+                
+                print("Calculating MPI Field, Month %i, Year %i" % (m,y))
+                with stage(unit_timers, 'compute'):
+                    jobs = [pool.submit(_mpi_tile, names, shapes, r0, r1, i0, i1, backend, warm_start, stride, report, tol)
+                            for r0, r1, i0, i1 in tiles]
+                    with tqdm(total=sum(r1-r0 for r0, r1, i0, i1 in tiles)) as progress:
+                        for job in as_completed(jobs):
+                            progress.update(job.result())
+                
+                last = (m,y)
+                iterations[(m,y)] = int(shared['niter'].sum())
+                
+                # the shared blocks are reused by the next unit, the writer gets copies
+                stats = (shared['niter'].copy(), shared['ncape'].copy(), shared['ifl'].copy()) if report else None
+                pm = shared['pm'].copy() if warm_start == 'prior' else None
+                pending.append(writer.submit(write_and_complete,
+                                             partial(write_unit, idx, m, y, shared['mpi'].copy(), stats, unit_timers, pm),
+                                             partial(complete, m, y, stats)))
+                finish_writes(pending, wait=not prefetch)
+            finish_writes(pending, wait=True)
+    finally:
+        del shared
+        for block in blocks.values():
+            block.close()
+            block.unlink()
+    
+    return iterations
+        
+#%% GLOBAL MODE
+
+# The basin boxes overlap (EP and NA share 255-285E between 5 and 60N) and every
+# basin reads the same global fields. MPI_map_global groups the basins into
+# regions of overlapping latitude bands (one per hemisphere), reads the fields of
+# the box around a region once per month/year, computes every ocean point of the
+# union of the basin boxes once and cuts the basin maps from the result. The maps,
+# manifests and reports are the same files as those of MPI_map.
+
+def basin_regions(basins = range(6)):
+    # tuples of basins whose latitude ranges overlap
+    regions = []
+    for idx in sorted(basins, key=lambda i: basin_slices(i)[0]):
+        if regions and basin_slices(idx)[0] < basin_slices(regions[-1])[1]:
+            regions[-1] = regions[-1] + (idx,)
+        else:
+            regions.append((idx,))
+    return regions
+
+def basin_view(field, idx, region):
+    # the part of a field of the region box (last two axes) that is in the box of basin idx
+    lat0,lat1,lon0,lon1 = basin_slices(region)
+    b0,b1,c0,c1 = basin_slices(idx)
+    return field[..., b0-lat0:b1-lat0, c0-lon0:c1-lon0]
+
+def region_index(region, basins, source = 'text', m = None, y = None):
+    # flat indices, in the region box, of the ocean points of the basins (a subset of the
+    # region); m, y as for ocean_index
+    lat0,lat1,lon0,lon1 = basin_slices(region)
+    points = [np.zeros(0, dtype=np.int64)]
+    for idx in basins:
+        b0,b1,c0,c1 = basin_slices(idx)
+        rows, cols = np.divmod(ocean_index(idx, source, m, y), c1-c0)
+        points.append(np.ravel_multi_index((rows + b0-lat0, cols + c0-lon0), (lat1-lat0, lon1-lon0)))
+    return np.unique(np.concatenate(points))
+
+def MPI_map_global(months_override = [], basins = range(6), source = 'text', warm_start = None, stride = 4,
+                   resume = True, report = False, prefetch = True, lut = None, tol = 0.001):
+    # MPI_map for several basins at once, every point shared by overlapping basins is
+    # computed once (see above). A month/year is computed for the basins that have it
+    # in MPI_MONTHS (or months_override) and are not done yet.
+    # warm_start, stride, resume, report, prefetch, lut and tol as for MPI_map; with 'neighbour'
+    # the coarse points are every stride-th row and column of the region box, so maps
+    # can differ slightly from those of MPI_map
+    # returns the total number of pcmin iterations per (basin, month, year)
+    
+    check_warm_start(warm_start)
+    
+    def basin_months(idx):
+        return months_override if len(months_override) > 0 else MPI_MONTHS[idx]
+    
+    iterations = {}
+    manifests = {idx: mpi_manifest.load_manifest(idx) for idx in basins}
+    
+    for region in basin_regions(basins):
+        # the basins of the region still to compute per (month, year)
+        todo = {}
+        inputs = {}
+        for m in sorted(set(m for idx in region for m in basin_months(idx))):
+            for y in MPI_YEARS:
+                inputs[(m,y)] = mpi_manifest.input_hash(m, y, source)
+                todo[(m,y)] = tuple(idx for idx in region if m in basin_months(idx) and not (resume and
+                                    mpi_manifest.is_done(manifests[idx], mpi_manifest.unit_key(idx, m, y), inputs[(m,y)],
+                                                         mpi_manifest.map_path(idx, m, y))))
+                if len(todo[(m,y)]) == 0:
+                    print("Month %i, Year %i MPI MAPS of basins %s already done." % (m,y,region))
+        units = [unit for unit in todo if len(todo[unit]) > 0]
+        for idx in region:
+            mpi_manifest.mark_units(idx, manifests[idx], {mpi_manifest.unit_key(idx, m, y): inputs[(m,y)]
+                                                          for m, y in units if idx in todo[(m,y)]}, 'pending')
+        indices = {}
+        timers = {unit: {} for unit in units} if report else None
+        pm_prior = None
+        last = None
+        pending = []
+        
+        def complete(m, y, basins_done, stats):
+            for idx in basins_done:
+                key = mpi_manifest.unit_key(idx, m, y)
+                mpi_manifest.mark_unit(idx, manifests[idx], key, 'done', inputs[(m,y)], iterations=iterations[(idx,m,y)])
+                print("Basin %i, Month %i, Year %i MPI MAP done." % (idx,m,y))
+                if report:
+                    summary = mpi_report.convergence_summary(idx, ocean_index(idx, source, m, y),
+                                                             *[basin_view(a, idx, region) for a in stats])
+                    mpi_report.print_report(mpi_report.save_report(idx, m, y, timers[(m,y)], summary, source=source,
+                                                                   warm_start=warm_start, region=region))
+        
+        def write(m, y, basins_done, mpi_map_month, stats, timers, pm):
+            for idx in basins_done:
+                write_unit(idx, m, y, basin_view(mpi_map_month, idx, region),
+                           None if stats is None else [basin_view(a, idx, region) for a in stats], timers,
+                           None if pm is None else basin_view(pm, idx, region))
         
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            for m, y, fields in load_units(region, units, source, timers, prefetch):
+                unit_timers = None if timers is None else timers[(m,y)]
+                for idx in todo[(m,y)]:
+                    mpi_manifest.mark_unit(idx, manifests[idx], mpi_manifest.unit_key(idx, m, y), 'running', inputs[(m,y)])
+                if todo[(m,y)] not in indices:
+                    indices[todo[(m,y)]] = region_index(region, todo[(m,y)], source, m, y)
+                index = indices[todo[(m,y)]]
+                
+                sst_region, mslp_region, t_grads, q_grads = fields
+                # the previous year's pressures, from this run or saved with the basin maps
+                pm0 = pm_prior if last == (m,y-1) else None
+                if pm0 is None and warm_start == 'prior':
+                    pm0 = np.full(sst_region.shape, np.nan)
+                    for idx in todo[(m,y)]:
+                        pm_basin = prior_pm(idx, m, y, source, manifests[idx])
+                        if pm_basin is not None:
+                            basin_view(pm0, idx, region)[:] = pm_basin
+                
+                print("Calculating MPI Field, Month %i, Year %i, basins %s" % (m,y,todo[(m,y)]))
+                with stage(unit_timers, 'compute'):
+                    tmf = pcmin_field(sst_region, mslp_region, P_GRAD, t_grads, q_grads, index=index, pm0=pm0,
+                                      stride=stride if warm_start else 0, stats=report, lut=lut, tol=tol)
+                del fields, sst_region, mslp_region, t_grads, q_grads
+                
+                last = (m,y)
+                pm_prior = tmf[9] if warm_start == 'prior' else None
+                for idx in todo[(m,y)]:
+                    iterations[(idx,m,y)] = int(basin_view(tmf[10], idx, region).sum())
+                
+                stats = (tmf[10], tmf[11], tmf[3]) if report else None
+                pending.append(writer.submit(write_and_complete,
+                                             partial(write, m, y, todo[(m,y)], tmf[0], stats, unit_timers, pm_prior),
+                                             partial(complete, m, y, todo[(m,y)], stats)))
+                finish_writes(pending, wait=not prefetch)
+            finish_writes(pending, wait=True)
+    
+    return iterations
+
 #%% CREATE MPI MAPS FOR YEARS 2008-2017 FOR SPECIFIC BASIN
 
 # Basin indices: 
@@ -153,20 +642,27 @@ def MPI_map(idx, months_override = []):
 # 4 = SP = South Pacific
 # 5 = WP = Western Pacific
 
-idx = 5
+# The cells only run as a script, so that worker processes of
+# MPI_map_parallel can import this module. Use MPI_map_parallel(idx) to
+# compute on all cores, MPI_map_global() to compute all basins at once, or
+# mpi_scheduler.py to run all basins, months and years on a cluster.
 
-MPI_map(idx)
+if __name__ == "__main__":
+    idx = 5
+    
+    MPI_map(idx)
 
 #%% PLOT WP MPI FIELDS FOR EACH MONTH,YEAR
 
-idx = 5
-
-for m in [5,6,7,8,9,10,11]:
-    for y in range(2008,2018):
-        mpi_map = np.loadtxt("MPI_MAP_BASIN"+str(idx)+"_MONTH" +str(m)+"_YEAR"+str(y)+".txt")
-        plt.pcolormesh(mpi_map)
-        plt.title("WP MPI Map, Month %i Year %i" % (m,y))
-        plt.colorbar()
-        plt.show()
+if __name__ == "__main__":
+    idx = 5
+    
+    for m in [5,6,7,8,9,10,11]:
+        for y in range(2008,2018):
+            mpi_map = np.loadtxt("MPI_MAP_BASIN"+str(idx)+"_MONTH" +str(m)+"_YEAR"+str(y)+".txt")
+            plt.pcolormesh(mpi_map)
+            plt.title("WP MPI Map, Month %i Year %i" % (m,y))
+            plt.colorbar()
+            plt.show()
 
     
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Lazy access to the ERA5 monthly mean NetCDF files.
+
+The files are opened once with dask-backed chunks of one time step, and only
+the basin box of the requested month and year is read from disk. Fields are
+returned in the orientation used by create_mpi_map (latitude from south to
+north, levels from 1000 to 1 hPa): the flips are done in the index math on
+the small box rather than on the global arrays, so no text export is needed.
+"""
+
+import numpy as np
+import xarray as xr
+from functools import lru_cache
+
+ERA5_FILES = {'sst': 'Monthly_mean_SST.nc',
+              'mslp': 'Monthly_mean_MSLP.nc',
+              't': 'Monthly_Mean_T.nc',
+              'q': 'Monthly_Mean_SH.nc'}
+
+ERA5_NAMES = {'sst': 'sst', 'mslp': 'msl', 't': 't', 'q': 'q'}
+
+@lru_cache(maxsize=None)
+def open_era5(var):
+    """
+    Open the ERA5 file of a variable lazily
+    Input:
+        var: 'sst', 'mslp', 't' or 'q'
+    Output:
+        field: dask-backed DataArray
+    """
+    data = xr.open_dataset(ERA5_FILES[var], chunks={'time': 1})
+    return data[ERA5_NAMES[var]]
+
+def era5_box(var, m, y, lat0, lat1, lon0, lon1):
+    """
+    Read a box of one month of an ERA5 variable
+    Input:
+        var: 'sst', 'mslp', 't' or 'q'
+        m: month (1-12)
+        y: year
+        lat0,lat1,lon0,lon1: grid indices of the box on the south-to-north grid,
+                             see create_mpi_map.basin_slices
+    Output:
+        field: array (lat, lon), or (level, lat, lon) from 1000 to 1 hPa, in ERA5 units
+    """
+    field = open_era5(var)
+    time = field.time
+    t_idx = np.flatnonzero((time.dt.year.values == y) & (time.dt.month.values == m))[0]
+
+    # rows lat0..lat1-1 of the flipped grid are rows nlat-lat1..nlat-lat0-1 of the file
+    nlat = field.latitude.size
+    box = field.isel(time=t_idx, latitude=slice(nlat-lat1, nlat-lat0), longitude=slice(lon0, lon1))
+    if 'level' in box.dims:
+        box = box.isel(level=slice(None, None, -1))
+
+    return np.asarray(box.values, dtype=np.float64)[..., ::-1, :]
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of the global monthly ERA5 fields as float32 .npy files.
+
+Every field is stored once per variable, month and year, already flipped to
+the create_mpi_map orientation and converted to the units used by pcmin
+(SST in C, MSLP in hPa, T in C, Q in g/kg). Fields are opened as read-only
+memory maps, so cutting out a basin is a view without a copy and processes
+working on the same month share the pages through the OS page cache.
+
+Each cache file has a small .json sidecar with the modification time and
+size of the ERA5 file it was built from; when the ERA5 file changes the
+cached field is rebuilt.
+"""
+
+import numpy as np
+import os
+import json
+from era5_fields import ERA5_FILES, era5_box, open_era5
+
+CACHE_DIR = 'FIELD_CACHE'
+
+def to_model_units(var, field):
+    """
+    Convert an ERA5 field to the units used by pcmin
+    """
+    if var == 'sst' or var == 't':
+        return field - 273.15
+    if var == 'mslp':
+        return field / 1e2
+    return field * 1e3
+
+def cache_path(var, m, y):
+    return os.path.join(CACHE_DIR, var.upper()+'_month'+str(m)+'_year'+str(y)+'.npy')
+
+def source_stamp(var):
+    stat = os.stat(ERA5_FILES[var])
+    return {'source': ERA5_FILES[var], 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+def is_valid(var, m, y):
+    """
+    Check whether the cached field exists and was built from the current ERA5 file
+    """
+    path = cache_path(var, m, y)
+    try:
+        with open(path[:-4]+'.json') as f:
+            stamp = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return False
+    return os.path.exists(path) and stamp == source_stamp(var)
+
+def build_field(var, m, y):
+    """
+    Convert one global field from ERA5 and write it (and its sidecar) atomically
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    stamp = source_stamp(var)
+    field = open_era5(var)
+    nlat, nlon = field.latitude.size, field.longitude.size
+    data = to_model_units(var, era5_box(var, m, y, 0, nlat, 0, nlon)).astype(np.float32)
+
+    # the sidecar is written last, so an interrupted build is never taken as valid
+    path = cache_path(var, m, y)
+    tmp = path[:-4]+'.'+str(os.getpid())+'.tmp'
+    np.save(tmp+'.npy', data)
+    os.replace(tmp+'.npy', path)
+    with open(tmp+'.json', 'w') as f:
+        json.dump(stamp, f)
+    os.replace(tmp+'.json', path[:-4]+'.json')
+
+def cached_field(var, m, y):
+    """
+    Global field of a variable for month m (1-12) and year y
+    Input:
+        var: 'sst', 'mslp', 't' or 'q'
+    Output:
+        field: read-only float32 memmap (lat, lon) or (level, lat, lon)
+    """
+    if not is_valid(var, m, y):
+        build_field(var, m, y)
+    return np.load(cache_path(var, m, y), mmap_mode='r')
+
+def cached_box(var, m, y, lat0, lat1, lon0, lon1):
+    """
+    Zero-copy view of a box of a cached field, indices as in create_mpi_map.basin_slices
+    """
+    return cached_field(var, m, y)[..., lat0:lat1, lon0:lon1]
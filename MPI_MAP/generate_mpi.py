@@ -7,40 +7,112 @@ Created on Sun Mar  6 21:55:15 2022
 """
 
 import numpy as np
+import os
+import warnings
+from functools import lru_cache
+from numpy.lib.format import open_memmap
+import mpi_manifest
+from create_mpi_map import MPI_MONTHS, MPI_YEARS
 import matplotlib.pyplot as plt
 
 #%% FUNCTIONS
 
-def mpi_analysis(idx, m):
-    
-    mpi_maps = np.zeros(10)
-    
-    for i in range(10):
-        y = 2008 + i
-        mpi_map = np.loadtxt("MPI_MAP_BASIN"+str(idx)+"_MONTH"+str(m)+"_YEAR"+str(y)+".txt")
-        mpi_maps[i] = mpi_map
+def load_mpi_maps(idx, m, years = MPI_YEARS):
+    """
+    Stack of the MPI maps of a basin and month computed by create_mpi_map
+    Input:
+        idx: basin index
+        m: month (1-12)
+        years: years of the maps
+    Output:
+        mpi_maps: array (year, lat, lon), nan over land
+    """
+    return np.stack([np.loadtxt(mpi_manifest.map_path(idx, m, y)) for y in years])
+
+def mpi_stats(mpi_maps, percentiles = ()):
+    """
+    Mean and standard deviation over the years of every gridpoint, ignoring nan
+    Input:
+        mpi_maps: array (year, lat, lon)
+        percentiles: extra percentiles (0-100) to compute
+    Output:
+        mean_map, std_map: arrays (lat, lon), std with ddof = 0 as np.std
+        pctl_maps: array (percentile, lat, lon)
+    """
+    with warnings.catch_warnings():
+        # all-nan (land) gridpoints stay nan
+        warnings.simplefilter('ignore', RuntimeWarning)
+        mean_map = np.nanmean(mpi_maps, axis=0)
+        std_map = np.nanstd(mpi_maps, axis=0)
+        pctl_maps = np.nanpercentile(mpi_maps, percentiles, axis=0) if len(percentiles) > 0 else np.empty((0,) + mpi_maps.shape[1:])
+    return(mean_map, std_map, pctl_maps)
+
+def mpi_stats_streaming(idx, m, years = MPI_YEARS):
+    """
+    Same mean and standard deviation as mpi_stats, but reading one map at a time
+    (Welford's algorithm), so the years are never all in memory
+    """
+    for i, y in enumerate(years):
+        mpi_map = np.loadtxt(mpi_manifest.map_path(idx, m, y))
+        if i == 0:
+            count = np.zeros(mpi_map.shape)
+            mean_map = np.zeros(mpi_map.shape)
+            m2_map = np.zeros(mpi_map.shape)
+        valid = ~np.isnan(mpi_map)
+        count += valid
+        delta = np.where(valid, mpi_map - mean_map, 0.)
+        mean_map += np.where(valid, delta / np.maximum(count, 1), 0.)
+        m2_map += np.where(valid, delta * (mpi_map - mean_map), 0.)
     
-    std_map = np.zeros(mpi_maps[0].shape)
-    mean_map = np.zeros(mpi_maps[0].shape)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_map = np.where(count > 0, mean_map, np.nan)
+        std_map = np.sqrt(m2_map / count)
+    return(mean_map, std_map)
+
+def mpi_analysis(idx, m, streaming = False, percentiles = (), years = MPI_YEARS):
+    # streaming: read the yearly maps one at a time instead of stacking them
+    # percentiles: also save PCTL<p>_MAP_BASIN<idx>_MONTH<m>.txt for every percentile p
+    #              (needs the stacked maps, so not with streaming)
+    # years: years of the MPI maps
     
-    for lat in range(mpi_maps[0].shape[0]):
-        for lon in range(mpi_maps[0].shape[1]):
-                mpis = mpi_maps[:,lat,lon]
-                std = np.std(mpis)
-                mean = np.mean(mpis)
-                std_map[lat,lon] = std
-                mean_map[lat,lon] = mean
+    if streaming:
+        if len(percentiles) > 0:
+            raise ValueError("percentiles need all years in memory, use streaming = False")
+        mean_map, std_map = mpi_stats_streaming(idx, m, years)
+    else:
+        mean_map, std_map, pctl_maps = mpi_stats(load_mpi_maps(idx, m, years), percentiles)
+        for p, pctl_map in zip(percentiles, pctl_maps):
+            np.savetxt("MEAN_STD/PCTL"+str(p)+"_MAP_BASIN"+str(idx)+"_MONTH"+str(m)+".txt", pctl_map)
     
     np.savetxt("MEAN_STD/MEAN_MAP_BASIN"+str(idx)+"_MONTH"+str(m)+".txt", mean_map)
     np.savetxt("MEAN_STD/STD_MAP_BASIN"+str(idx)+"_MONTH"+str(m)+".txt", std_map)
     
-    mean_std = np.mean(std_map)
-    mean_mpi = np.mean(mean_map)
+    # averages over the ocean points
+    mean_std = np.nanmean(std_map)
+    mean_mpi = np.nanmean(mean_map)
     
     print("Average MPI across Grid: ", mean_mpi)
     print("Average STD across Grid: ", mean_std)
+    # the fields generated from the old maps are stale
+    mean_std_maps.cache_clear()
+    _load_eof.cache_clear()
+    _mpi_field.cache_clear()
     return(mean_mpi, mean_std)
 
+def mpi_analysis_all(basins = range(6), streaming = False, percentiles = (), years = MPI_YEARS):
+    """
+    Run mpi_analysis for all MPI months of the given basins
+    Output:
+        results: dict {(idx, m): (mean_mpi, mean_std)}
+    """
+    os.makedirs("MEAN_STD", exist_ok=True)
+    results = {}
+    for idx in basins:
+        for m in MPI_MONTHS[idx]:
+            print("Basin %i, Month %i" % (idx, m))
+            results[(idx, m)] = mpi_analysis(idx, m, streaming, percentiles, years)
+    return results
+
 def mpi_generate(idx, m, no_years):
     
     MPI_means = np.loadtxt("MEAN_STD/MEAN_MAP_BASIN" + str(idx) +"_MONTH"+ str(m) + ".txt")
@@ -49,6 +121,178 @@ def mpi_generate(idx, m, no_years):
     for year in range(no_years):
         MPI_gen = np.random.normal(MPI_means, MPI_stds)
         np.savetxt("GEN_MPI_FIELDS_BASIN" + str(idx) +"_MONTH"+ str(m) + "_YEAR"+ str(year) + ".txt", MPI_gen)
-            
 
+@lru_cache(maxsize=16)
+def mean_std_maps(idx, m):
+    MPI_means = np.loadtxt("MEAN_STD/MEAN_MAP_BASIN" + str(idx) +"_MONTH"+ str(m) + ".txt")
+    MPI_stds = np.loadtxt("MEAN_STD/STD_MAP_BASIN" + str(idx) +"_MONTH"+ str(m) + ".txt")
+    return(MPI_means, MPI_stds)
+
+def map_stamp(idx, m, years = MPI_YEARS):
+    """
+    Names, sizes and modification times of the MPI maps of a basin and month
+    """
+    stamp = []
+    for y in years:
+        stat = os.stat(mpi_manifest.map_path(idx, m, y))
+        stamp.append(mpi_manifest.map_path(idx, m, y) + ':' + str(stat.st_size) + ':' + str(stat.st_mtime_ns))
+    return ';'.join(stamp)
+
+def eof_path(idx, m):
+    return "MEAN_STD/EOF_BASIN" + str(idx) + "_MONTH" + str(m) + ".npz"
+
+def fit_eof(idx, m, n_modes = None, years = MPI_YEARS):
+    """
+    Low-rank spatial covariance of the yearly MPI maps (EOF/PCA)
+    Input:
+        idx: basin index
+        m: month (1-12)
+        n_modes: number of EOFs to keep (all by default, at most the number of years)
+        years: years of the MPI maps, as for mpi_analysis
+    Output:
+        mean_map: array (lat, lon)
+        index: flat indices of the ocean points
+        factors: array (point, mode), the covariance of the ocean points is factors @ factors.T
+        explained: fraction of the variance of every EOF
+    """
+    mpi_maps = load_mpi_maps(idx, m, years)
+    n = mpi_maps.shape[0]
+    mean_map, std_map, _ = mpi_stats(mpi_maps)
+    index = np.flatnonzero(~np.isnan(mean_map))
+    
+    # anomalies of missing years are set to 0
+    anomalies = np.nan_to_num(mpi_maps.reshape(n, -1)[:, index] - mean_map.ravel()[index])
+    _, s, vt = np.linalg.svd(anomalies / np.sqrt(n), full_matrices=False)
+    explained = s**2 / max(np.sum(s**2), np.finfo(float).tiny)
+    if n_modes is not None:
+        s, vt = s[:n_modes], vt[:n_modes]
+    factors = vt.T * s
+    
+    # scale every point to the std of mpi_analysis (only changes points with missing years or truncated modes)
+    var = np.sum(factors**2, axis=1)
+    std = std_map.ravel()[index]
+    factors *= np.where(var > 0, std / np.sqrt(np.where(var > 0, var, 1)), 0)[:, None]
+    return(mean_map, index, factors, explained)
+
+def load_eof(idx, m, n_modes = None, years = MPI_YEARS):
+    """
+    fit_eof, cached in MEAN_STD/EOF_BASIN<idx>_MONTH<m>.npz and refitted when the MPI maps
+    (or their years) change
+    """
+    return _load_eof(idx, m, n_modes, map_stamp(idx, m, years), tuple(years))
+
+@lru_cache(maxsize=16)
+def _load_eof(idx, m, n_modes, stamp, years):
+    # load_eof for the maps of this stamp, kept in memory until the maps change
+    path = eof_path(idx, m)
+    if os.path.exists(path):
+        with np.load(path) as data:
+            if str(data['stamp']) == stamp and int(data['n_modes']) == (-1 if n_modes is None else n_modes):
+                return(data['mean'], data['index'], data['factors'], data['explained'])
+    
+    mean_map, index, factors, explained = fit_eof(idx, m, n_modes, years)
+    tmp = path[:-4] + "." + str(os.getpid()) + ".tmp.npz"
+    np.savez(tmp, mean=mean_map, index=index, factors=factors, explained=explained,
+             stamp=stamp, n_modes=-1 if n_modes is None else n_modes)
+    os.replace(tmp, path)
+    return(mean_map, index, factors, explained)
+
+def sample_fields(idx, m, rng, no_years, mode = 'independent', n_modes = None, years = MPI_YEARS):
+    """
+    Draw no_years MPI fields of a basin and month
+    Input:
+        rng: numpy Generator
+        mode: 'independent' draws every gridpoint from its own normal distribution (as mpi_generate),
+              'eof' draws spatially correlated fields from the EOFs of the MPI maps (see fit_eof)
+        n_modes: number of EOFs for mode = 'eof'
+        years: years of the MPI maps the EOFs are fitted to (mode = 'eof')
+    Output:
+        MPI_gen: array (year, lat, lon)
+    """
+    if mode == 'independent':
+        MPI_means, MPI_stds = mean_std_maps(idx, m)
+        return MPI_means + MPI_stds * rng.standard_normal((no_years,) + MPI_means.shape)
+    if mode == 'eof':
+        mean_map, index, factors, _ = load_eof(idx, m, n_modes, years)
+        MPI_gen = np.full((no_years, mean_map.size), np.nan)
+        MPI_gen[:, index] = mean_map.ravel()[index] + rng.standard_normal((no_years, factors.shape[1])) @ factors.T
+        return MPI_gen.reshape((no_years,) + mean_map.shape)
+    raise ValueError("unknown mode " + str(mode))
+
+def gen_path(idx, m):
+    return "GEN_MPI/GEN_MPI_BASIN" + str(idx) + "_MONTH" + str(m) + ".npy"
+
+def mpi_generate_batch(idx, m, no_years, seed = None, block_years = 500, mode = 'independent', n_modes = None,
+                       years = MPI_YEARS):
+    """
+    Generate no_years MPI fields of a basin and month into one float32 array
+    Input:
+        idx: basin index
+        m: month (1-12)
+        no_years: number of synthetic years
+        seed: seed of the numpy Generator (int, SeedSequence or None); the same
+              seed gives the same fields for any block_years
+        block_years: number of years drawn at once
+        mode, n_modes, years: see sample_fields
+    Output:
+        GEN_MPI/GEN_MPI_BASIN<idx>_MONTH<m>.npy, array (year, lat, lon)
+        returns the path of the file
+    """
+    MPI_means, _ = mean_std_maps(idx, m)
+    rng = np.random.default_rng(seed)
+    
+    os.makedirs("GEN_MPI", exist_ok=True)
+    path = gen_path(idx, m)
+    tmp = path[:-4] + "." + str(os.getpid()) + ".tmp.npy"
+    MPI_gen = open_memmap(tmp, mode='w+', dtype=np.float32, shape=(no_years,) + MPI_means.shape)
+    for y0 in range(0, no_years, block_years):
+        y1 = min(y0 + block_years, no_years)
+        MPI_gen[y0:y1] = sample_fields(idx, m, rng, y1 - y0, mode, n_modes, years)
+    MPI_gen.flush()
+    del MPI_gen
+    os.replace(tmp, path)
+    return path
+
+def load_generated(idx, m):
+    """
+    Generated MPI fields of a basin and month as a read-only memmap (year, lat, lon)
+    """
+    return np.load(gen_path(idx, m), mmap_mode='r')
+
+def year_rng(idx, m, year, seed = 0):
+    """
+    Counter-based (Philox) generator of one synthetic year, keyed on (seed, basin, month, year),
+    so every year can be drawn on its own and in any order
+    """
+    return np.random.Generator(np.random.Philox(np.random.SeedSequence([seed, idx, m, year])))
+
+def mpi_field(idx, m, year, seed = 0, mode = 'independent', n_modes = None, years = MPI_YEARS):
+    """
+    MPI field of one synthetic year, generated on demand from the MEAN_STD maps
+    Input:
+        idx: basin index
+        m: month (1-12)
+        year: synthetic year (0, 1, ...)
+        seed: seed of the ensemble
+        mode, n_modes, years: see sample_fields
+    Output:
+        MPI_gen: read-only array (lat, lon), the same for the same arguments and MPI maps
+    """
+    # the EOFs are refitted when the MPI maps change, so are the fields drawn from them
+    return _mpi_field(idx, m, year, seed, mode, n_modes, map_stamp(idx, m, years) if mode == 'eof' else None, tuple(years))
+
+@lru_cache(maxsize=32)
+def _mpi_field(idx, m, year, seed, mode, n_modes, stamp, years):
+    # mpi_field for the maps of this stamp
+    MPI_gen = sample_fields(idx, m, year_rng(idx, m, year, seed), 1, mode, n_modes, years)[0]
+    MPI_gen.flags.writeable = False
+    return MPI_gen
 
+def export_mpi_fields(idx, m, years, seed = 0, mode = 'independent', n_modes = None, map_years = MPI_YEARS):
+    """
+    Write on-demand fields of the synthetic years in the text format of mpi_generate, to GEN_MPI/
+    (map_years: years of the MPI maps, see sample_fields)
+    """
+    os.makedirs("GEN_MPI", exist_ok=True)
+    for year in years:
+        np.savetxt("GEN_MPI/GEN_MPI_FIELDS_BASIN" + str(idx) +"_MONTH"+ str(m) + "_YEAR"+ str(year) + ".txt", mpi_field(idx, m, year, seed, mode, n_modes, map_years))
@@ -17,99 +17,176 @@ import numpy as np
 import os
 import sys
 import xarray as xr
+import netCDF4
+from xarray.backends.locks import HDF5_LOCK
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from era5_fields import open_era5
 dir_path=os.path.dirname(os.path.realpath(sys.argv[0]))
 __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
 
-####### GET FIELDS PER YEAR FOR 2008-2017 ###############################
-
-def pressure_peryear(data):
-    
-    mslp=data.msl.values #mslp=data.msl.values, changed by Shirin, 29/09/2021
-    # lon=data.longitude.values
-    # lat=data.latitude.values
+####### CHUNKED BINARY STORE FOR THE LEVEL FIELDS #######################
+
+# Instead of one text file per month, year and level, ingest writes T and Q
+# to one compressed NetCDF4 file per variable, chunked per time step, level
+# and 1/16 of the globe. The store is already in the orientation used by
+# create_mpi_map: levels from 1000 to 1 hPa, latitude from south to north.
+
+STORE_FILES = {'t': 'T_FIELDS/T_STORE.nc', 'q': 'Q_FIELDS/Q_STORE.nc'}
+
+def read_level_field(var, m, y, lat0, lat1, lon0, lon1):
+    """
+    Read one month of a level field from the store
+    Input:
+        var: 't' or 'q'
+        m: month (1-12)
+        y: year
+        lat0,lat1,lon0,lon1: grid indices of the box (south to north), as in create_mpi_map.basin_slices
+    Output:
+        field: array (level, lat, lon) in the units of ERA5 (K, kg/kg)
+    """
+    with xr.open_dataset(STORE_FILES[var]) as data:
+        time = data.time
+        t_idx = np.flatnonzero((time.dt.year.values == y) & (time.dt.month.values == m))[0]
+        field = data[var][t_idx, :, lat0:lat1, lon0:lon1].values
     
-    for month in range(0,12):
-        for t in range(28,38):    
-            year = 1980 + t
-            mslp_field = mslp[month+t*12,:,:]
-            np.savetxt('MSLP_FIELDS/MSLP_month'+str(month+1)+'_year'+str(year)+'.txt',mslp_field)
-
-def sst_peryear(data):
+    return field.astype(np.float64)
+
+
+####### FUSED INGEST OF SST, MSLP, T AND Q ##############################
+
+# ingest exports all variables in one pass: the ERA5 files are opened lazily
+# and read one month at a time, all variables of that month are written on a
+# thread pool while the next month is read. Months are 1-12 in all file names.
+
+TEXT_DIRS = {'sst': 'SST_FIELDS', 'mslp': 'MSLP_FIELDS', 't': 'T_FIELDS', 'q': 'Q_FIELDS'}
+
+def text_path(var, m, y, level=None):
+    path = TEXT_DIRS[var]+'/'+var.upper()+'_month'+str(m)+'_year'+str(y)
+    if level is not None:
+        path += '_level'+str(level)
+    return path+'.txt'
+
+def create_store(var, field, overwrite=False):
+    """
+    Open the level store of a variable for writing. An existing store is kept and
+    months are added to it or replaced (see store_slot)
+    Input:
+        var: 't' or 'q'
+        field: ERA5 DataArray of the variable
+        overwrite: start a new, empty store instead
+    Output:
+        store: open netCDF4 Dataset
+    """
+    nlat, nlon = field.latitude.size, field.longitude.size
+    if os.path.exists(STORE_FILES[var]) and not overwrite:
+        store = netCDF4.Dataset(STORE_FILES[var], 'a')
+        if store[var].shape[1:] != (field.level.size, nlat, nlon):
+            store.close()
+            raise ValueError(STORE_FILES[var]+" has another grid, use overwrite=True (--overwrite) to replace it")
+        return store
     
-    sst=data.sst.values #mslp=data.msl.values, changed by Shirin, 29/09/2021
-    # lon=data.longitude.values
-    # lat=data.latitude.values
-    
-    for month in range(0,12):
-        for t in range(28,38):    
-            year = 1980 + t
-            sst_field = sst[month+t*12,:,:]
-            np.savetxt('SST_FIELDS/SST_month'+str(month+1)+'_year'+str(year)+'.txt',sst_field)
-
-def t_peryear(data):
+    store = netCDF4.Dataset(STORE_FILES[var], 'w')
+    for dim, size in (('time', None), ('level', field.level.size), ('latitude', nlat), ('longitude', nlon)):
+        store.createDimension(dim, size)
     
-    t = data.t.values
-    print("t loaded")
-    # lon = data.longitude.values
-    # print("lon loaded")
-    # lat = data.latitude.values
-    # print("lat loaded")
-    levels = data.level.values
-    print("levels loaded")
+    time = store.createVariable('time', 'f8', ('time',))
+    time.units = 'days since 1900-01-01'
+    time.calendar = 'gregorian'
+    for dim, values in (('level', field.level.values[::-1]), ('latitude', field.latitude.values[::-1]), ('longitude', field.longitude.values)):
+        store.createVariable(dim, values.dtype, (dim,))[:] = values
     
-    for month in range(12):
-        for y in range(0, 10):
-            year = y + 2008
-            t_field = t[month+y*12, ::-1, :, :]
-            for level in range(len(levels)):
-                t_field_level = t_field[level, :, :]
-                np.savetxt("T_FIELDS/T_month"+str(month)+"_year"+str(year)+"_level"+str(level)+".txt", t_field_level)
-                print("T Month %i, year %i, level %i saved" % (month, year, level))
+    store.createVariable(var, 'f4', ('time', 'level', 'latitude', 'longitude'), zlib=True, complevel=4, shuffle=True,
+                         chunksizes=(1, 1, -(-nlat//4), -(-nlon//4)))
+    return store
+
+def store_slot(store, y, m):
+    """
+    Time index of month m, year y in a store; a month that is not in the store yet
+    gets a new index after the last one
+    """
+    time = store['time']
+    days = (np.datetime64('%04d-%02d-01' % (y, m)) - np.datetime64('1900-01-01')).astype(int)
+    k = np.flatnonzero(np.asarray(time[:]) == days)
+    if len(k) > 0:
+        return int(k[0])
+    k = len(time)
+    time[k] = days
+    return k
+
+def write_slice(var, m, y, data, store=None, k=None, lock=None):
+    """
+    Write one month of a variable (array as in the ERA5 file) to text files or to slot k of a store
+    """
+    if var == 'sst' or var == 'mslp':
+        np.savetxt(text_path(var, m, y), data)
+    elif store is None:
+        data = data[::-1]
+        for level in range(data.shape[0]):
+            np.savetxt(text_path(var, m, y, level), data[level])
+    else:
+        data = np.ascontiguousarray(data[::-1, ::-1], dtype=np.float32)
+        with lock:
+            store[var][k] = data
+
+def ingest(years=range(2008,2018), months=range(1,13), variables=('sst','mslp','t','q'), store=True, workers=4, overwrite=False):
+    """
+    Export ERA5 fields for create_mpi_map in a single pass over the months
+    Input:
+        years: years to export
+        months: months to export (1-12)
+        variables: any of 'sst', 'mslp', 't', 'q'
+        store: write T and Q to the chunked stores (STORE_FILES) instead of text files per level
+        workers: number of writer threads
+        overwrite: replace the stores instead of adding these months to them
+    Output:
+        SST_FIELDS/SST_month<m>_year<y>.txt, MSLP_FIELDS/MSLP_month<m>_year<y>.txt and
+        T and Q as stores or T_FIELDS/T_month<m>_year<y>_level<l>.txt (levels from 1000 to 1 hPa)
+    """
+    steps = [(y, m) for y in years for m in months]
+    fields = {var: open_era5(var) for var in variables}
+    for var in variables:
+        os.makedirs(TEXT_DIRS[var], exist_ok=True)
+    stores = {var: create_store(var, fields[var], overwrite) for var in variables if store and var in ('t', 'q')}
+    slots = {var: [store_slot(stores[var], y, m) for y, m in steps] for var in stores}
+    # the HDF5 library is not thread-safe, store writes share the lock xarray takes for reading
+    locks = {var: HDF5_LOCK for var in stores}
     
-def q_peryear(data):
-    
-    q = data.q.values
-    print("q loaded")
-    # lon = data.longitude.values
-    # print("lon loaded")
-    # lat = data.latitude.values
-    # print("lat loaded")
-    levels = data.level.values
-    print("levels loaded")
-    
-    for month in range(12):
-        for y in range(0, 10):
-            year = y + 2008
-            q_field = q[month+y*12, ::-1, :, :]
-            for level in range(len(levels)):
-                q_field_level = q_field[level, :, :]
-                np.savetxt("Q_FIELDS/Q_month"+str(month)+"_year"+str(year)+"_level"+str(level)+".txt", q_field_level)
-                print("Q Month %i, year %i, level %i saved" % (month, year, level))
-
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = []
+            for k, (y, m) in enumerate(steps):
+                # read the month of every variable while the previous month is being written
+                writes = []
+                for var in variables:
+                    field = fields[var]
+                    time = field.time
+                    t_idx = np.flatnonzero((time.dt.year.values == y) & (time.dt.month.values == m))[0]
+                    data = field[t_idx].values
+                    writes.append(pool.submit(write_slice, var, m, y, data, stores.get(var),
+                                              slots[var][k] if var in stores else None, locks.get(var)))
+                for future in pending:
+                    future.result()
+                pending = writes
+                print("Month %i, year %i read" % (m, y))
+            for future in pending:
+                future.result()
+    finally:
+        for var in stores:
+            stores[var].close()
+    print("Ingest done")
 
 #%%
 
-data=xr.open_dataset('Monthly_mean_SST.nc')
-sst_peryear(data)
-data.close()
-
-print("SST done")
-
-data=xr.open_dataset('Monthly_mean_MSLP.nc')
-pressure_peryear(data)
-data.close()
-
-print("MSLP done")
-
-data=xr.open_dataset("Monthly_Mean_T.nc")
-t_peryear(data)
-data.close()
-
-print("T done")
-
-
-data=xr.open_dataset("Monthly_Mean_SH.nc")
-q_peryear(data)
-data.close()
-
-print("Q done")
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export ERA5 SST, MSLP, T and Q for create_mpi_map")
+    parser.add_argument('--years', type=int, nargs=2, default=[2008, 2017], metavar=('FIRST', 'LAST'))
+    parser.add_argument('--months', type=int, nargs='+', default=list(range(1, 13)))
+    parser.add_argument('--variables', nargs='+', default=['sst', 'mslp', 't', 'q'], choices=['sst', 'mslp', 't', 'q'])
+    parser.add_argument('--text', action='store_true', help="write T and Q as text files per level instead of the stores")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--overwrite', action='store_true', help="replace the T and Q stores instead of adding the months to them")
+    args = parser.parse_args()
+    
+    ingest(range(args.years[0], args.years[1]+1), args.months, args.variables,
+           store=not args.text, workers=args.workers, overwrite=args.overwrite)
@@ -0,0 +1,127 @@
+#======-------------------------------------------------------------------
+#
+#     Lookup table of the parcel temperature of reversible ascent above
+#       the LCL, as solved by the Newton iteration of cape. The parcel
+#       temperature TG is the root of SG(TG,P,RP) = S, so it depends on the
+#       parcel entropy S, the pressure P (mb) and, through the heat capacity
+#       of the condensate, on the parcel mixing ratio RP (gm/gm). The table
+#       is tabulated over (RP,S,P) on a regular grid and interpolated
+#       trilinearly; the mixing ratio RG follows from TG and P.
+#
+#     The table is built once by inverting SG(T) on a fine temperature grid
+#       and cached in MOIST_ADIABAT_TABLE.npz next to this file.
+#
+#======-------------------------------------------------------------------
+#
+import numpy as np
+import os
+#
+TABLE_FILE=os.path.join(os.path.dirname(os.path.abspath(__file__)),'MOIST_ADIABAT_TABLE.npz')
+#
+#====== Thermodynamic constants, as in cape
+#
+CPD=1005.7
+CPV=1870.0
+CL=2500.0
+CPVMCL=CPV-CL
+RV=461.5
+RD=287.04
+EPS=RD/RV
+ALV0=2.501e6
+#
+#====== Table grid: RP (gm/gm), S (J/kg/K), P (mb) and the fine temperature
+#======   grid (K) that is inverted. The S range covers the parcels of
+#======   pcmin (surface air from about 250 to 310 K)
+#
+GRID={'RP0':0.0,'RP1':0.05,'NRP':26,'S0':3000.0,'S1':5000.0,'NS':401,
+      'P0':50.0,'P1':1100.0,'NP':211,'T0':150.0,'T1':340.0,'NT':9501}
+#
+def saturation_entropy(TG,P,RP) :
+   #
+   #====== Reversible entropy SG of saturated air at TG (K) and P (mb) with
+   #======   total water RP, and the saturation vapour pressure ENEW (mb)
+   #
+   TC=TG-273.15
+   ENEW=6.112*np.exp(17.67*TC/(243.5+TC))
+   RG=EPS*ENEW/(P-ENEW)
+   ALV=ALV0+CPVMCL*TC
+   EM=RG*P/(EPS+RG)
+   SG=(CPD+RP*CL)*np.log(TG)-RD*np.log(P-EM)+ALV*RG/TG
+   return SG,ENEW
+   #
+def build_table(grid=GRID) :
+   #
+   #====== Tabulate TG over (RP,S,P). For every RP and P the entropy SG(T)
+   #======   increases with T, so T(S) is found with np.interp on a fine T
+   #======   grid. Temperatures where ENEW > P-1 (where cape bails out) are
+   #======   left out and give nan in the table.
+   #
+   RPG=np.linspace(grid['RP0'],grid['RP1'],grid['NRP'])
+   PG=np.linspace(grid['P0'],grid['P1'],grid['NP'])
+   TF=np.linspace(grid['T0'],grid['T1'],grid['NT'])
+   #
+   SGRID=np.linspace(grid['S0'],grid['S1'],grid['NS'])
+   #
+   with np.errstate(invalid='ignore') :
+      VALID=6.112*np.exp(17.67*(TF[None,:]-273.15)/(TF[None,:]-29.65)) <= PG[:,None]-1
+      TTAB=np.full((RPG.size,SGRID.size,PG.size),np.nan,dtype='float32')
+      for I in range(RPG.size) :
+         SG,ENEW=saturation_entropy(TF[None,:],PG[:,None],RPG[I])
+         for K in range(PG.size) :
+            TTAB[I,:,K]=np.interp(SGRID,SG[K,VALID[K]],TF[VALID[K]],left=np.nan,right=np.nan)
+         #
+   return {'RP':RPG,'S':SGRID,'P':PG,'T':TTAB,
+           'grid':np.array([grid[k] for k in sorted(grid)],dtype='float')}
+   #
+def load_table(grid=GRID,path=TABLE_FILE) :
+   #
+   #====== Read the cached table, or build and cache it if there is none
+   #======   for this grid
+   #
+   KEY=np.array([grid[k] for k in sorted(grid)],dtype='float')
+   if os.path.exists(path) :
+      with np.load(path) as data :
+         if np.array_equal(data['grid'],KEY) :
+            return {k:data[k] for k in data.files}
+            #
+   TAB=build_table(grid)
+   TMP=path[:-4]+'.'+str(os.getpid())+'.tmp.npz'
+   np.savez(TMP,**TAB)
+   os.replace(TMP,path)
+   return TAB
+   #
+def adiabat_lookup(S,P,RP,TAB) :
+   #
+   #====== Trilinear interpolation of TG at parcel entropy S, pressure P
+   #======   and mixing ratio RP (arrays of the same shape). Returns TG, and
+   #======   nan outside the table or where a corner of the cell is missing
+   #
+   S=np.asarray(S,dtype='float')
+   P=np.asarray(P,dtype='float')
+   RP=np.asarray(RP,dtype='float')
+   TG=np.zeros(S.shape)
+   INSIDE=np.ones(S.shape,dtype='bool')
+   IDX=[]
+   FRAC=[]
+   for X,G in ((RP,TAB['RP']),(S,TAB['S']),(P,TAB['P'])) :
+      U=(X-G[0])/(G[1]-G[0])
+      INSIDE=INSIDE & (U >= 0) & (U <= G.size-1)
+      I=np.clip(np.floor(np.nan_to_num(U)).astype('int'),0,G.size-2)
+      IDX.append(I)
+      FRAC.append(np.clip(np.nan_to_num(U)-I,0.0,1.0))
+      #
+   TTAB=TAB['T']
+   for DI in (0,1) :
+      for DJ in (0,1) :
+         for DK in (0,1) :
+            W=((FRAC[0] if DI else 1-FRAC[0])*(FRAC[1] if DJ else 1-FRAC[1])
+               *(FRAC[2] if DK else 1-FRAC[2]))
+            TG=TG+W*TTAB[IDX[0]+DI,IDX[1]+DJ,IDX[2]+DK]
+            #
+   return np.where(INSIDE,TG,np.nan)
+   #
+#======-------------------------------------------------------------------
+#
+if __name__ == "__main__" :
+   TAB=load_table()
+   print("Table", TAB['T'].shape, "S from %.1f to %.1f" % (TAB['S'][0],TAB['S'][-1]))
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Job manifest and checkpoints for resumable MPI map production.
+
+Every basin/month/year map is a unit with a status (pending, running, done)
+and a hash of its inputs in MPI_MAPS/MANIFEST_BASIN<idx>.json (one manifest
+per basin, so basins can run in separate jobs). A unit is skipped on restart
+when it is done, its output exists and its inputs have not changed.
+
+Maps, manifests and checkpoints are written to a temporary file first and
+then moved into place, so a killed job never leaves a half-written file.
+Jobs of the same basin (e.g. one per month/year, see mpi_scheduler) update the
+manifest under a file lock and only change their own units.
+Row checkpoints keep the rows of a map computed so far, so a long basin map
+can be resumed in the middle.
+"""
+
+import numpy as np
+import os
+import json
+import hashlib
+import time
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from era5_fields import ERA5_FILES
+from import_fields import STORE_FILES
+
+STATUSES = ('pending', 'running', 'done')
+
+def manifest_path(idx):
+    return "MPI_MAPS/MANIFEST_BASIN" + str(idx) + ".json"
+
+def unit_key(idx, m, y):
+    return "BASIN" + str(idx) + "_MONTH" + str(m) + "_YEAR" + str(y)
+
+def map_path(idx, m, y):
+    return "MPI_MAPS/MPI_MAP_BASIN" + str(idx) + "_MONTH" + str(m) + "_YEAR" + str(y) + ".txt"
+
+def checkpoint_path(idx, m, y):
+    return "MPI_MAPS/CHECKPOINT_" + unit_key(idx, m, y) + ".npz"
+
+def pm_path(idx, m, y):
+    # iterated pressures of a map, kept with warm_start = 'prior' for the next year
+    return "MPI_MAPS/PM_" + unit_key(idx, m, y) + ".npy"
+
+def replace_atomic(write, path):
+    """
+    Call write(tmp) on a temporary file next to path, then move it to path
+    """
+    root, ext = os.path.splitext(path)
+    tmp = root + '.' + str(os.getpid()) + '.tmp' + ext
+    write(tmp)
+    os.replace(tmp, path)
+
+def save_map(path, mpi_map):
+    replace_atomic(lambda tmp: np.savetxt(tmp, mpi_map), path)
+
+def input_files(m, y, source = 'text'):
+    """
+    Files a map of month m, year y is computed from, for the sources of create_mpi_map.load_basin_fields
+    """
+    if source == 'era5' or source == 'cache':
+        return [ERA5_FILES[var] for var in ('sst', 'mslp', 't', 'q')]
+
+    files = ['SST_FIELDS/SST_month'+str(m)+'_year'+str(y)+'.txt',
+             'MSLP_FIELDS/MSLP_month'+str(m)+'_year'+str(y)+'.txt']
+    if source == 'store':
+        return files + [STORE_FILES['t'], STORE_FILES['q']]
+    for var in ('T', 'Q'):
+        files += [var+"_FIELDS/"+var+"_month"+str(m)+"_year"+str(y)+"_level"+str(level)+".txt" for level in range(37)]
+    return files
+
+def input_hash(m, y, source = 'text'):
+    """
+    Hash of the names, sizes and modification times of the input files
+    """
+    h = hashlib.sha1(source.encode())
+    for path in input_files(m, y, source):
+        try:
+            stat = os.stat(path)
+            h.update((path + ':' + str(stat.st_size) + ':' + str(stat.st_mtime_ns) + ';').encode())
+        except FileNotFoundError:
+            h.update((path + ':missing;').encode())
+    return h.hexdigest()
+
+def load_manifest(idx):
+    try:
+        with open(manifest_path(idx)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+@contextmanager
+def manifest_lock(idx):
+    # exclusive lock on MPI_MAPS/MANIFEST_BASIN<idx>.lock (no locking where fcntl is missing)
+    if fcntl is None:
+        yield
+        return
+    with open(manifest_path(idx)[:-5] + ".lock", 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def save_manifest(idx, manifest):
+    def write(tmp):
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+    replace_atomic(write, manifest_path(idx))
+
+def mark_unit(idx, manifest, key, status, inputs, **info):
+    """
+    Set the status of a unit and save the manifest. Units updated by other jobs since
+    the manifest was loaded are kept
+    """
+    mark_units(idx, manifest, {key: inputs}, status, **info)
+
+def mark_units(idx, manifest, units, status, **info):
+    """
+    Set the status of several units (dict {key: inputs}) and save the manifest once,
+    e.g. to register all units of a run as pending when it starts
+    """
+    if len(units) == 0:
+        return
+    stamp = time.strftime('%Y-%m-%dT%H:%M:%S')
+    for key in units:
+        manifest[key] = dict(manifest.get(key, {}), status=status, inputs=units[key], time=stamp, **info)
+    with manifest_lock(idx):
+        current = load_manifest(idx)
+        for key in units:
+            current[key] = manifest[key]
+        save_manifest(idx, current)
+
+def is_done(manifest, key, inputs, output):
+    unit = manifest.get(key, {})
+    return unit.get('status') == 'done' and unit.get('inputs') == inputs and os.path.exists(output)
+
+def save_checkpoint(path, inputs, row, **arrays):
+    """
+    Save the first `row` rows of a map being computed, with the arrays needed to continue
+    """
+    replace_atomic(lambda tmp: np.savez(tmp, inputs=inputs, row=row, **arrays), path)
+
+def load_checkpoint(path, inputs):
+    """
+    Checkpoint of a map as a dict (row and arrays), or None if there is none for these inputs
+    """
+    try:
+        with np.load(path) as data:
+            if str(data['inputs']) != inputs:
+                return None
+            return {k: data[k] for k in data.files}
+    except FileNotFoundError:
+        return None
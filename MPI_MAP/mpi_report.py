@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Instrumentation of MPI map production, switched on with MPI_map(idx, report=True).
+
+For every basin/month/year map this writes to MPI_MAPS/:
+    STATS_BASIN<idx>_MONTH<m>_YEAR<y>.npz:  per-point maps of the pcmin iterations
+        (np), CAPE Newton iterations (ncape) and pcmin flag (ifl: 1 converged,
+        2 CAPE did not converge, 0 rejected or hypercane)
+    REPORT_BASIN<idx>_MONTH<m>_YEAR<y>.json: wall-clock time of the stages (load,
+        convert, compute, write) and a summary of the convergence, with the
+        locations of the slowest points
+With prefetching (MPI_map(..., prefetch=True)) load, convert and write run on
+background threads while other units are computed; 'wait' is the time the
+computation waited for its fields.
+"""
+
+import numpy as np
+import json
+import time
+from contextlib import contextmanager
+import preprocessing
+import mpi_manifest
+
+STAGES = ('load', 'convert', 'wait', 'compute', 'write')
+
+@contextmanager
+def stage(timers, name):
+    """
+    Add the wall-clock time of the with-block to timers[name] (nothing is timed when timers is None)
+    """
+    if timers is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        timers[name] = timers.get(name, 0.) + time.perf_counter() - t0
+
+def report_path(idx, m, y):
+    return "MPI_MAPS/REPORT_" + mpi_manifest.unit_key(idx, m, y) + ".json"
+
+def stats_path(idx, m, y):
+    return "MPI_MAPS/STATS_" + mpi_manifest.unit_key(idx, m, y) + ".npz"
+
+def save_stats(idx, m, y, np_map, ncape_map, ifl_map):
+    mpi_manifest.replace_atomic(lambda tmp: np.savez(tmp, np=np_map, ncape=ncape_map, ifl=ifl_map),
+                                stats_path(idx, m, y))
+
+def distribution(values):
+    if values.size == 0:
+        return {}
+    return {'total': int(values.sum()), 'mean': float(values.mean()), 'p50': float(np.percentile(values, 50)),
+            'p99': float(np.percentile(values, 99)), 'max': int(values.max())}
+
+def convergence_summary(idx, index, np_map, ncape_map, ifl_map, slowest = 10):
+    """
+    Summary of the convergence over the ocean points of a basin map
+    Input:
+        idx: basin index
+        index: flat indices of the ocean points (create_mpi_map.ocean_index)
+        np_map, ncape_map, ifl_map: maps of pcmin iterations, CAPE Newton iterations and IFL
+        slowest: number of points with the most CAPE Newton iterations to list
+    Output:
+        dict with the distributions of the iteration counts, the number of points per
+        outcome and the latitude, longitude and counts of the slowest points
+    """
+    lat0,lat1,lon0,lon1 = preprocessing.BOUNDARIES_BASINS(idx)
+    nx = np_map.shape[1]
+    npit = np.asarray(np_map).ravel()[index].astype(np.int64)
+    ncape = np.asarray(ncape_map).ravel()[index].astype(np.int64)
+    ifl = np.asarray(ifl_map).ravel()[index].astype(np.int64)
+
+    worst = index[np.argsort(ncape, kind='stable')[::-1][:slowest]]
+    rows, cols = np.divmod(worst, nx)
+    return {'points': int(index.size),
+            'pcmin_iterations': distribution(npit),
+            'cape_newton_iterations': distribution(ncape),
+            'outcomes': {'converged': int(np.sum(ifl == 1)), 'cape_not_converged': int(np.sum(ifl == 2)),
+                         'hypercane': int(np.sum((ifl == 0) & (npit > 0))), 'rejected': int(np.sum((ifl == 0) & (npit == 0)))},
+            'slowest': [{'lat': lat0 + r/4, 'lon': lon0 + c/4, 'pcmin_iterations': int(np.ravel(np_map)[k]),
+                         'cape_newton_iterations': int(np.ravel(ncape_map)[k]), 'ifl': int(np.ravel(ifl_map)[k])}
+                        for r, c, k in zip(rows, cols, worst)]}
+
+def save_report(idx, m, y, timers, summary, **info):
+    """
+    Write the run report of one basin/month/year map
+    """
+    report = dict(info, basin=idx, month=m, year=y, time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  seconds={name: timers.get(name, 0.) for name in STAGES}, total_seconds=sum(timers.values()),
+                  convergence=summary)
+    def write(tmp):
+        with open(tmp, 'w') as f:
+            json.dump(report, f, indent=1)
+    mpi_manifest.replace_atomic(write, report_path(idx, m, y))
+    return report
+
+def print_report(report):
+    seconds = report['seconds']
+    conv = report['convergence']
+    print("  " + ", ".join("%s %.1f s" % (name, seconds[name]) for name in STAGES)
+          + "; %i points: %i converged, %i CAPE not converged, %i hypercanes, %i rejected"
+          % ((conv['points'],) + tuple(conv['outcomes'].values())))
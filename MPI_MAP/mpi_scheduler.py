@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Task graph runner for the full MPI production over basins, months and years.
+
+The production is split into tasks:
+    ('map', idx, m, y):    create_mpi_map.MPI_map of basin idx for month m, year y
+    ('analysis', idx, m):  generate_mpi.mpi_analysis, after the maps of all years of (idx, m)
+    ('generate', idx, m):  generate_mpi.mpi_generate_batch, after the analysis of (idx, m)
+Tasks are submitted as soon as their dependencies are done, largest first (the map
+tasks of a basin cost its number of ocean points), to one of the backends:
+    'local': a process pool on this machine
+    'dask':  a dask.distributed cluster (address of the scheduler, or a local cluster
+             of `workers` processes to test on one node)
+    'mpi':   mpi4py.futures over the ranks of an MPI job (mpiexec -n N python -m mpi4py.futures ...)
+A failed task does not stop the run: its dependent tasks are skipped and all failures
+are listed at the end. Map tasks skip units that are done (see mpi_manifest), so a run
+can be repeated to redo the failed part.
+
+    python mpi_scheduler.py --basins 0 1 5 --backend local --workers 8
+    python mpi_scheduler.py --backend dask --address tcp://scheduler:8786 --no-years 10000
+"""
+
+import numpy as np
+import os
+import sys
+import json
+import time
+import argparse
+import traceback
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from multiprocessing import get_context
+import create_mpi_map
+import generate_mpi
+from create_mpi_map import MPI_MONTHS, MPI_YEARS
+
+STAGES = ('map', 'analysis', 'generate')
+
+#%% TASK GRAPH
+
+def build_graph(basins = range(6), months_override = [], years = MPI_YEARS, stages = STAGES):
+    """
+    Tasks of the production and their dependencies
+    Input:
+        basins: basin indices
+        months_override: months for all basins instead of MPI_MONTHS
+        years: years of the MPI maps
+        stages: kinds of tasks to include; dependencies on stages that are left out are dropped
+    Output:
+        deps: dict {task: tuple of tasks it depends on}, in dependency order
+    """
+    deps = {}
+    for idx in basins:
+        months = months_override if len(months_override) > 0 else MPI_MONTHS[idx]
+        for m in months:
+            maps = tuple(('map', idx, m, y) for y in years) if 'map' in stages else ()
+            for task in maps:
+                deps[task] = ()
+            if 'analysis' in stages:
+                deps[('analysis', idx, m)] = maps
+            if 'generate' in stages:
+                deps[('generate', idx, m)] = (('analysis', idx, m),) if 'analysis' in stages else maps
+    return deps
+
+def task_cost(task, source = 'text'):
+    """
+    Relative cost of a task: the number of ocean points of the basin for map tasks
+    (the size of the basin box before the ocean index of the source exists), 0 for the others
+    """
+    if task[0] != 'map':
+        return 0
+    path = create_mpi_map.ocean_index_path(task[1], source)
+    if os.path.exists(path):
+        with np.load(path) as saved:
+            return len(saved['index'])
+    lat0,lat1,lon0,lon1 = create_mpi_map.basin_slices(task[1])
+    return int((lat1-lat0) * (lon1-lon0))
+
+def priority(deps, source = 'text'):
+    """
+    Priority of every task: its own cost plus the largest priority of the tasks that
+    depend on it, so long chains and large basins start first
+    """
+    users = {task: [] for task in deps}
+    for task in deps:
+        for dep in deps[task]:
+            users[dep].append(task)
+    prio = {}
+    for task in reversed(list(deps)):
+        prio[task] = task_cost(task, source) + max([prio[user] for user in users[task]], default=0)
+    return prio
+
+#%% TASKS
+
+def run_task(task, options):
+    """
+    Run one task in a worker
+    Input:
+        task: see the module docstring
+        options: dict with source, warm_start, stride, resume (map tasks), streaming,
+                 percentiles (analysis tasks), no_years, seed, mode, n_modes (generate tasks),
+                 years (analysis and generate tasks, the years of the maps); every year is
+                 a task of its own, so warm_start 'prior' has no effect
+    Output:
+        result of the task (iterations, mean MPI and STD, or path of the generated fields)
+    """
+    kind, idx, m = task[:3]
+    if kind == 'map':
+        os.makedirs("MPI_MAPS", exist_ok=True)
+        return create_mpi_map.MPI_map(idx, [m], source=options.get('source', 'text'), warm_start=options.get('warm_start'),
+                                      stride=options.get('stride', 4), resume=options.get('resume', True),
+                                      years_override=[task[3]])
+    if kind == 'analysis':
+        os.makedirs("MEAN_STD", exist_ok=True)
+        return generate_mpi.mpi_analysis(idx, m, options.get('streaming', False), options.get('percentiles', ()),
+                                         options.get('years', MPI_YEARS))
+    if kind == 'generate':
+        # one seed per basin and month, so the fields do not depend on the order of the tasks
+        seed = np.random.SeedSequence([options.get('seed', 0), idx, m])
+        return generate_mpi.mpi_generate_batch(idx, m, options.get('no_years', 1000), seed,
+                                               mode=options.get('mode', 'independent'), n_modes=options.get('n_modes'),
+                                               years=options.get('years', MPI_YEARS))
+    raise ValueError("unknown task " + str(task))
+
+def run_safely(run, task, options):
+    # the result, or the error and traceback of a failed task (which the workers send back
+    # as strings, so that any exception can be collected)
+    t0 = time.perf_counter()
+    try:
+        return {'status': 'done', 'result': run(task, options), 'seconds': time.perf_counter() - t0}
+    except Exception as error:
+        return {'status': 'failed', 'error': repr(error), 'traceback': traceback.format_exc(),
+                'seconds': time.perf_counter() - t0}
+
+#%% BACKENDS
+
+def _init_worker():
+    # one numba thread per worker process, the pool provides the parallelism
+    if create_mpi_map.HAS_NUMBA:
+        import numba
+        numba.set_num_threads(1)
+
+@contextmanager
+def executor(backend = 'local', workers = None, address = None):
+    """
+    concurrent.futures executor of a backend (see the module docstring)
+    """
+    if backend == 'local':
+        # spawned workers: forking a process that already runs numba threads is not safe
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn'), initializer=_init_worker) as pool:
+            yield pool
+    elif backend == 'dask':
+        try:
+            from distributed import Client, LocalCluster
+        except ImportError:
+            raise ImportError("the dask backend needs dask.distributed (pip install distributed)")
+        if address is None:
+            with LocalCluster(n_workers=workers or 1, threads_per_worker=1) as cluster, Client(cluster) as client:
+                yield client.get_executor()
+        else:
+            with Client(address) as client:
+                yield client.get_executor()
+    elif backend == 'mpi':
+        try:
+            from mpi4py.futures import MPIPoolExecutor
+        except ImportError:
+            raise ImportError("the mpi backend needs mpi4py (pip install mpi4py)")
+        with MPIPoolExecutor(max_workers=workers) as pool:
+            yield pool
+    else:
+        raise ValueError("backend must be 'local', 'dask' or 'mpi'")
+
+#%% SCHEDULER
+
+def run_graph(deps, pool, options = {}, run = run_task):
+    """
+    Run the tasks of a graph on an executor, each task as soon as its dependencies are done
+    Input:
+        deps: task graph, see build_graph
+        pool: concurrent.futures executor
+        options: passed to run
+        run: function run(task, options) executed by the workers
+    Output:
+        results: dict {task: dict with status ('done', 'failed' or 'skipped'), result or
+                 error and traceback, seconds}
+    """
+    prio = priority(deps, options.get('source', 'text'))
+    waiting = {task: set(deps[task]) for task in deps}
+    results = {}
+    running = {}
+
+    def submit_ready():
+        ready = sorted([task for task in waiting if len(waiting[task]) == 0], key=lambda task: -prio[task])
+        for task in ready:
+            del waiting[task]
+            running[pool.submit(run_safely, run, task, options)] = task
+
+    def skip(task, failed):
+        # skip the tasks that depend on a failed or skipped task, recursively
+        for user in [user for user in waiting if task in waiting[user]]:
+            if user not in waiting:
+                continue
+            del waiting[user]
+            results[user] = {'status': 'skipped', 'error': "depends on " + str(failed)}
+            skip(user, failed)
+
+    submit_ready()
+    while running:
+        finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+        for future in finished:
+            task = running.pop(future)
+            try:
+                results[task] = future.result()
+            except Exception as error:
+                # lost worker, or a result that could not be sent back
+                results[task] = {'status': 'failed', 'error': repr(error), 'traceback': traceback.format_exc()}
+            if results[task]['status'] == 'done':
+                for user in waiting:
+                    waiting[user].discard(task)
+            else:
+                print("FAILED %s: %s" % (task, results[task]['error']))
+                skip(task, task)
+        submit_ready()
+
+    return results
+
+def summarize(results):
+    """
+    Print the number of done, failed and skipped tasks and every failure
+    Output:
+        failures: list of the failed tasks
+    """
+    counts = {status: sum(r['status'] == status for r in results.values()) for status in ('done', 'failed', 'skipped')}
+    print("%i tasks done, %i failed, %i skipped" % (counts['done'], counts['failed'], counts['skipped']))
+    failures = [task for task in results if results[task]['status'] == 'failed']
+    for task in failures:
+        print("  %s: %s" % (task, results[task]['error']))
+    skipped = [task for task in results if results[task]['status'] == 'skipped']
+    if len(skipped) > 0:
+        print("  skipped: " + ", ".join(str(task) for task in skipped))
+    return failures
+
+def save_results(results, path):
+    # task, status, error and seconds of every task as JSON (results are left out)
+    report = [dict({k: v for k, v in results[task].items() if k != 'result'}, task=list(task)) for task in results]
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1)
+
+def run_production(basins = range(6), months_override = [], years = MPI_YEARS, stages = STAGES,
+                   backend = 'local', workers = None, address = None, options = {}):
+    """
+    Build the task graph and run it on a backend (the analysis and generate tasks use the maps of years)
+    Output:
+        results: see run_graph
+    """
+    deps = build_graph(basins, months_override, years, stages)
+    options = dict(options, years=list(years))
+    print("%i tasks on the %s backend" % (len(deps), backend))
+    with executor(backend, workers, address) as pool:
+        results = run_graph(deps, pool, options)
+    summarize(results)
+    return results
+
+#%%
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the MPI map production as a task graph")
+    parser.add_argument('--basins', type=int, nargs='+', default=list(range(6)))
+    parser.add_argument('--months', type=int, nargs='+', default=[], help="instead of MPI_MONTHS")
+    parser.add_argument('--years', type=int, nargs=2, default=[MPI_YEARS[0], MPI_YEARS[-1]], metavar=('FIRST', 'LAST'))
+    parser.add_argument('--stages', nargs='+', default=list(STAGES), choices=STAGES)
+    parser.add_argument('--backend', default='local', choices=['local', 'dask', 'mpi'])
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--address', default=None, help="address of the dask scheduler")
+    parser.add_argument('--source', default='text', choices=['text', 'store', 'era5', 'cache'])
+    parser.add_argument('--warm-start', default=None, choices=['neighbour'])
+    parser.add_argument('--no-years', type=int, default=1000, help="synthetic years to generate")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--results', default=None, help="save the status of every task to this JSON file")
+    args = parser.parse_args()
+
+    options = {'source': args.source, 'warm_start': args.warm_start, 'no_years': args.no_years, 'seed': args.seed}
+    results = run_production(args.basins, args.months, range(args.years[0], args.years[1]+1), args.stages,
+                             args.backend, args.workers, args.address, options)
+    if args.results:
+        save_results(results, args.results)
+    sys.exit(1 if any(r['status'] == 'failed' for r in results.values()) else 0)
@@ -28,13 +28,17 @@
 #              indicates no convergence (hypercane); a value of 2
 #              means that the CAPE routine failed.
 #
+#  PM0 (optional) is the first guess of the minimum pressure (mb) used to
+#  start the iteration.
+#
 #-----------------------------------------------------------------------------
 #
 import numpy as np
-from cape import cape
+from cape import cape, cape_batch
+from pcmin_jit import HAS_NUMBA, pcmin_columns_jit
 #import cape #swy 1/3/2022
 #
-def pcmin(SST,PSL,P,T,R):
+def pcmin(SST,PSL,P,T,R,PM0=970.0):
    #
    #   ***   Adjustable constant: Ratio of C_k to C_D    ***
    #
@@ -88,7 +92,7 @@ def pcmin(SST,PSL,P,T,R):
       #
    IFL=1
    NP=0
-   PM=970.0
+   PM=PM0
    PMOLD=PM
    PNEW=0.0
    #
@@ -167,3 +171,295 @@ def pcmin(SST,PSL,P,T,R):
          #
    return(PMIN,VMAX,TO,IFL,RAT,CAPEMS,CAPEM,FAC,CAPEA)
    #
+#
+#-----------------------------------------------------------------------------
+#
+#   Array version of pcmin. pcmin_columns takes N columns at once:
+#
+#  INPUT:   SST, PSL: arrays of shape (N,), in C and mb
+#
+#           P: one-dimensional array of pressure levels (mb), shared by
+#             all columns and ordered as for pcmin
+#
+#           T, R: arrays of shape (N, NLEV) of temperature (C) and
+#             mixing ratio (g/kg)
+#
+#           PM0: optional first guesses (mb) of the iterated pressure,
+#             shape (N,); NaN or None starts from 970 mb as pcmin does
+#
+#           LUT, TOL: optional moist-adiabat table and tolerance, passed
+#             on to cape_batch
+#
+#           STATS: if True, also return NCAPE
+#
+#  The fixed-point iteration for the minimum pressure runs on all columns
+#  in lockstep, with both CAPE evaluations of each iteration done by
+#  cape_batch. Columns leave the iteration as soon as they have converged
+#  or have been found to be hypercanes (NP > 200 or PM < 400).
+#
+#  OUTPUT:  PMIN, VMAX, TO, IFL, RAT, CAPEMS, CAPEM, FAC, CAPEA as arrays
+#           of shape (N,), with the meaning of the pcmin outputs. Columns
+#           that pcmin rejects (SST <= 5 C, T <= 100 K or missing SST)
+#           are NaN with IFL = 0.
+#
+#           PM is the converged iterated pressure (a good first guess for
+#           neighbouring columns) and NP the number of iterations.
+#
+#           NCAPE (only with STATS=True) is the number of CAPE Newton
+#           iterations of the column, summed over levels and over all
+#           cape_batch calls.
+#
+#-----------------------------------------------------------------------------
+#
+def pcmin_columns(SST,PSL,P,T,R,PM0=None,LUT=None,TOL=0.001,STATS=False):
+   #
+   #   ***   Adjustable constants, as in pcmin   ***
+   #
+   CKCD=0.9
+   SIG=0.0
+   IDISS=1
+   b=2.0
+   NK=0
+   VREDUC=0.8
+   #
+   #--------------------------------------------------------------------------
+   #
+   SST=np.asarray(SST,dtype='float')
+   PSL=np.asarray(PSL,dtype='float')
+   P=np.asarray(P,dtype='float')
+   T=np.asarray(T,dtype='float')+273.15
+   R=np.asarray(R,dtype='float')*0.001
+   NCOL=SST.size
+   #
+   PMIN=np.full(NCOL,np.nan)
+   VMAX=np.full(NCOL,np.nan)
+   TO=np.full(NCOL,np.nan)
+   IFL=np.zeros(NCOL,dtype='int')
+   RAT=np.full(NCOL,np.nan)
+   CAPEMS=np.full(NCOL,np.nan)
+   CAPEM=np.full(NCOL,np.nan)
+   FAC=np.full(NCOL,np.nan)
+   CAPEA=np.full(NCOL,np.nan)
+   PMIT=np.full(NCOL,np.nan)
+   NPIT=np.zeros(NCOL,dtype='int')
+   NCAPE=np.zeros(NCOL,dtype='int')
+   #
+   VALID=np.isfinite(SST) & ~(SST <= 5.0)
+   if (NCOL > 0) :
+      VALID=VALID & ~(np.min(T,axis=1) <= 100.0)
+   COL=np.flatnonzero(VALID)
+   if (COL.size == 0) :
+      return(PMIN,VMAX,TO,IFL,RAT,CAPEMS,CAPEM,FAC,CAPEA,PMIT,NPIT)+((NCAPE,) if STATS else ())
+      #
+   SST=SST[COL]
+   PSL=PSL[COL]
+   T=T[COL]
+   R=R[COL]
+   SSTK=SST+273.15
+   ES0=6.112*np.exp(17.67*SST/(243.5+SST))
+   #
+   IFLC=np.ones(COL.size,dtype='int')
+   NP=np.zeros(COL.size,dtype='int')
+   PM=np.full(COL.size,970.0)
+   if PM0 is not None :
+      PM0=np.broadcast_to(np.asarray(PM0,dtype='float'),(NCOL,))[COL]
+      PM=np.where(np.isfinite(PM0),PM0,PM)
+   TVAV=np.full(COL.size,np.nan)
+   TOC=np.full(COL.size,np.nan)
+   RATC=np.full(COL.size,np.nan)
+   CAPEMC=np.full(COL.size,np.nan)
+   CAPEMSC=np.full(COL.size,np.nan)
+   HYPER=np.zeros(COL.size,dtype='bool')
+   NC=np.zeros(COL.size,dtype='int')
+   #
+   #   ***   Find environmental CAPE ***
+   #
+   CAPEAC, tmp, IFLAG, NIT=cape_batch(T[:,NK],R[:,NK],P[NK],T,R,P,SIG,LUT,TOL,NITER=True)
+   IFLC[IFLAG != 1]=2
+   NC=NC+NIT
+   #
+   #   ***   Iterate all columns to find minimum pressure   ***
+   #
+   A=np.arange(COL.size)
+   while (A.size > 0) :
+      #
+      #   ***  Find CAPE at radius of maximum winds   ***
+      #
+      TP=T[A,NK]
+      RK=R[A,NK]
+      PP=np.where(1000.0 < PM[A],1000.0,PM[A])
+      RP=0.622*RK*PSL[A]/(PP*(0.622+RK)-RK*PSL[A])
+      CAPEMC[A], TOM, IFLAG, NIT=cape_batch(TP,RP,PP,T[A],R[A],P,SIG,LUT,TOL,NITER=True)
+      IFLC[A[IFLAG != 1]]=2
+      NC[A]=NC[A]+NIT
+      #
+      #  ***  Find saturation CAPE at radius of maximum winds   ***
+      #
+      TP=SSTK[A]
+      RP=0.622*ES0[A]/(PP-ES0[A])
+      CAPEMSC[A], TOMS, IFLAG, NIT=cape_batch(TP,RP,PP,T[A],R[A],P,SIG,LUT,TOL,NITER=True)
+      TOC[A]=TOMS
+      IFLC[A[IFLAG != 1]]=2
+      NC[A]=NC[A]+NIT
+      #
+      RATC[A]=SSTK[A]/TOMS
+      if (IDISS == 0) :
+         RATC[A]=1.0
+         #
+      #  ***  Estimate of minimum pressure   ***
+      #
+      RS0=RP
+      TV1=T[A,0]*(1.+R[A,0]/0.622)/(1.+R[A,0])
+      TVAV[A]=0.5*(TV1+SSTK[A]*(1.+RS0/0.622)/(1.+RS0))
+      CAT=CAPEMC[A]-CAPEAC[A]+0.5*CKCD*RATC[A]*(CAPEMSC[A]-CAPEMC[A])
+      CAT=np.where(0.0 > CAT,0.0,CAT)
+      PNEW=PSL[A]*np.exp(-CAT/(287.04*TVAV[A]))
+      #
+      #   ***  Test for convergence, retire converged and hypercane columns   ***
+      #
+      PMOLD=PM[A]
+      PM[A]=PNEW
+      NP[A]=NP[A]+1
+      #
+      HYP=(NP[A] > 200) | (PM[A] < 400)
+      HYPER[A[HYP]]=True
+      A=A[~HYP & (np.abs(PNEW-PMOLD) > 0.2)]
+      #
+   CATFAC=0.5*(1.+1./b)
+   CAT=CAPEMC-CAPEAC+CKCD*RATC*CATFAC*(CAPEMSC-CAPEMC)
+   CAT=np.where(0.0 > CAT,0.0,CAT)
+   PMINC=PSL*np.exp(-CAT/(287.04*TVAV))
+   #
+   DIFF=CAPEMSC-CAPEMC
+   FACC=np.where(DIFF > 0.0,DIFF,0.0)
+   VMAXC=VREDUC*np.sqrt(CKCD*RATC*FACC)
+   #
+   #   ***   Hypercanes only report their flag   ***
+   #
+   PMINC[HYPER]=np.nan
+   VMAXC[HYPER]=np.nan
+   TOC[HYPER]=np.nan
+   IFLC[HYPER]=0
+   OK=~HYPER
+   #
+   PMIN[COL]=PMINC
+   VMAX[COL]=VMAXC
+   TO[COL]=TOC
+   IFL[COL]=IFLC
+   RAT[COL[OK]]=RATC[OK]
+   CAPEMS[COL[OK]]=CAPEMSC[OK]
+   CAPEM[COL[OK]]=CAPEMC[OK]
+   FAC[COL[OK]]=FACC[OK]
+   CAPEA[COL[OK]]=CAPEAC[OK]
+   PMIT[COL[OK]]=PM[OK]
+   NPIT[COL]=NP
+   NCAPE[COL]=NC
+   #
+   return(PMIN,VMAX,TO,IFL,RAT,CAPEMS,CAPEM,FAC,CAPEA,PMIT,NPIT)+((NCAPE,) if STATS else ())
+   #
+#-----------------------------------------------------------------------------
+#
+#   pcmin over whole fields, e.g. a basin at one month.
+#
+#  INPUT:   sst, psl: fields of shape (ny, nx) (any shape works), C and mb
+#
+#           p: one-dimensional array of pressure levels (mb)
+#
+#           t, r: fields of shape (nlev, ny, nx), temperature (C) and
+#             mixing ratio (g/kg), levels ordered as p
+#
+#           backend: 'numpy' for pcmin_columns, 'jit' for the compiled
+#             pcmin_jit.pcmin_columns_jit, 'auto' for 'jit' whenever
+#             numba is available
+#
+#           index: flat indices (into sst.ravel()) of the points to compute,
+#             e.g. a precomputed ocean index; by default all points with
+#             a finite SST
+#
+#           pm0: optional field of first guesses of the iterated pressure,
+#             e.g. PM of the same month in the previous year; NaN where
+#             there is no guess
+#
+#           stride: if > 0, points without a guess are warm-started from
+#             a neighbour: every stride-th row and column is computed
+#             first, and the other points start from the PM of the
+#             computed point at the south-west corner of their block
+#
+#           stats: if True, also return the field NCAPE of CAPE Newton
+#             iterations (see pcmin_columns)
+#
+#           lut, tol: optional moist-adiabat table and tolerance (see
+#             pcmin_columns); a table needs the numpy backend, 'auto'
+#             then uses it and 'jit' is an error
+#
+#  OUTPUT:  PMIN, VMAX, TO, IFL, RAT, CAPEMS, CAPEM, FAC, CAPEA, PM, NP (and
+#           NCAPE) as fields of the shape of sst. Points outside index are
+#           NaN (IFL = 0, NP = 0).
+#
+#-----------------------------------------------------------------------------
+#
+def pcmin_engine(backend='auto'):
+   #
+   if (backend == 'auto') :
+      backend='jit' if HAS_NUMBA else 'numpy'
+   return pcmin_columns_jit if backend == 'jit' else pcmin_columns
+   #
+def pcmin_field(sst,psl,p,t,r,backend='auto',index=None,pm0=None,stride=0,stats=False,lut=None,tol=0.001):
+   #
+   sst=np.asarray(sst)
+   psl=np.asarray(psl)
+   t=np.asarray(t)
+   r=np.asarray(r)
+   if index is None :
+      index=np.flatnonzero(np.isfinite(sst.ravel()))
+      #
+   if (lut is not None) :
+      if (backend == 'jit') :
+         raise ValueError("the moist-adiabat table (lut) needs backend 'numpy' or 'auto'")
+      backend='numpy'
+      options={'LUT':lut,'TOL':tol}
+   else :
+      options={}
+   engine=pcmin_engine(backend)
+   seed=np.full(index.size,np.nan) if pm0 is None else np.asarray(pm0,dtype='float').ravel()[index]
+   #
+   #   ***   Gather the active points into compact columns   ***
+   #
+   def run(sel):
+      iy=np.unravel_index(index[sel],sst.shape)
+      return engine(np.asarray(sst[iy],dtype='float'),np.asarray(psl[iy],dtype='float'),p,
+                    np.asarray(t[(slice(None),)+iy].T,dtype='float'),
+                    np.asarray(r[(slice(None),)+iy].T,dtype='float'),seed[sel],STATS=stats,**options)
+      #
+   if (stride > 0) and (sst.ndim == 2) :
+      #
+      #   ***   First pass on the coarse points, then seed the rest from them   ***
+      #
+      iy,ix=np.unravel_index(index,sst.shape)
+      first=np.isnan(seed) & (iy % stride == 0) & (ix % stride == 0)
+      rest=~first
+      cols1=run(first)
+      pmc=np.full(sst.size,np.nan)
+      pmc[index[first]]=cols1[9]
+      corner=np.ravel_multi_index((iy-iy % stride,ix-ix % stride),sst.shape)
+      seed=np.where(np.isnan(seed),pmc[corner],seed)
+      cols2=run(rest)
+      cols=[]
+      for c1,c2 in zip(cols1,cols2):
+         col=np.empty(index.size,dtype=c1.dtype)
+         col[first]=c1
+         col[rest]=c2
+         cols.append(col)
+   else :
+      cols=run(slice(None))
+      #
+   #   ***   Scatter the results back into full fields   ***
+   #
+   out=[]
+   for col in cols:
+      field=np.full(sst.size,np.nan) if col.dtype.kind == 'f' else np.zeros(sst.size,dtype=col.dtype)
+      field[index]=col
+      out.append(field.reshape(sst.shape))
+      #
+   return tuple(out)
+   #
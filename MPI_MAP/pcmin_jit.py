@@ -0,0 +1,375 @@
+#-----------------------------------------------------------------------------
+#
+#   Compiled versions of cape and pcmin.
+#
+#   The kernels below are line-by-line ports of cape.cape and
+#   pcmin_fullterm.pcmin to numba's nopython mode; pcmin_columns_jit runs
+#   pcmin_kernel over grid columns in parallel with prange and has the
+#   same inputs and outputs as pcmin_fullterm.pcmin_columns. Compiled
+#   kernels are cached on disk (cache=True), so only the first run on a
+#   machine pays for the compilation.
+#
+#   numba is optional: if it cannot be imported HAS_NUMBA is False and the
+#   kernels stay plain Python functions. pcmin_fullterm.pcmin_field only
+#   selects this backend when HAS_NUMBA is True.
+#
+#   Running this module checks the kernels against the reference Python
+#   implementation on ERA5-like tropical soundings.
+#
+#-----------------------------------------------------------------------------
+#
+import numpy as np
+#
+try:
+   from numba import njit, prange
+   HAS_NUMBA=True
+except ImportError:
+   HAS_NUMBA=False
+   prange=range
+   #
+   def njit(*args,**kwargs):
+      if len(args) == 1 and callable(args[0]):
+         return args[0]
+      return lambda func: func
+      #
+#
+@njit(cache=True)
+def cape_kernel(TP,RP,PP,T,R,P,SIG):
+   #
+   #====== Pressure below which sounding is ignored
+   ptop=59.0
+   #
+   Nold=P.size
+   N=0
+   for i in range(Nold-1,-1,-1) :
+      if (P[i] > ptop) :
+         N=i
+         break
+         #
+   TVRDIF=np.zeros(N+1)
+   #
+   #====== Get minimum sounding level at or above PP
+   #
+   JMIN=-1
+   for i in range(0,N+1) :
+      if (P[i] <= PP) :
+         JMIN=i
+         break
+         #
+   #====== Default values
+   #
+   CAPED=0.0
+   TOB=T[0]
+   IFLAG=1
+   NCT=0
+   #
+   #====== Check that sounding is suitable
+   #
+   if (RP < 1e-6) or (TP < 200) or (JMIN < 0) :
+      return np.nan,np.nan,0,0
+      #
+   #====== Assign values of thermodynamic constants
+   #
+   CPD=1005.7
+   CPV=1870.0
+   CL=2500.0
+   CPVMCL=CPV-CL
+   RV=461.5
+   RD=287.04
+   EPS=RD/RV
+   ALV0=2.501e6
+   #
+   #====== Define various parcel quantities, including reversible
+   #======                      entropy, S.
+   #
+   TPC=TP-273.15
+   ESP=6.112*np.exp(17.67*TPC/(243.5+TPC))
+   EVP=RP*PP/(EPS+RP)
+   RH=EVP/ESP
+   if (RH > 1.0) :
+      RH=1.0
+   ALV=ALV0+CPVMCL*TPC
+   S=(CPD+RP*CL)*np.log(TP)-RD*np.log(PP-EVP)+ALV*RP/TP-RP*RV*np.log(RH)
+   #
+   #====== Find lifted condensation pressure, PLCL
+   #
+   CHI=TP/(1669.0-122.0*RH-TP)
+   PLCL=PP*(RH**CHI)
+   #
+   #====== Begin updraft loop
+   #
+   for J in range(JMIN,N+1) :
+      #
+      if (P[J] >= PLCL) :
+         TG=TP*(P[J]/PP)**(RD/CPD)
+         RG=RP
+         TLVR=TG*(1.+RG/EPS)/(1.+RG)
+         TVRDIF[J]=TLVR-T[J]*(1.+R[J]/EPS)/(1+R[J])
+      else :
+         TGNEW=T[J]
+         TJC=T[J]-273.15
+         ES=6.112*np.exp(17.67*TJC/(243.5+TJC))
+         RG=EPS*ES/(P[J]-ES)
+         #
+         #====== Iteratively calculate lifted parcel temperature and mixing
+         #======                ratio for reversible ascent
+         #
+         NC=0
+         TG=0.0
+         #
+         while ((np.abs(TGNEW-TG)) > 0.001) :
+            #
+            TG=TGNEW
+            TC=TG-273.15
+            ENEW=6.112*np.exp(17.67*TC/(243.5+TC))
+            RG=EPS*ENEW/(P[J]-ENEW)
+            #
+            NC=NC+1
+            #
+            ALV=ALV0+CPVMCL*(TG-273.15)
+            SL=(CPD+RP*CL+ALV*ALV*RG/(RV*TG*TG))/TG
+            EM=RG*P[J]/(EPS+RG)
+            SG=(CPD+RP*CL)*np.log(TG)-RD*np.log(P[J]-EM)+ALV*RG/TG
+            #
+            if (NC < 3) :
+               AP=0.3
+            else :
+               AP=1.0
+               #
+            TGNEW=TG+AP*(S-SG)/SL
+            #
+            #------ Bail out if things get out of hand
+            #
+            if (NC > 500) or (ENEW > (P[J]-1)) :
+               IFLAG=2
+            if (NC > 500) :
+               break
+               #
+         NCT=NCT+NC
+         RMEAN=SIG*RG+(1-SIG)*RP
+         TLVR=TG*(1.+RG/EPS)/(1.+RMEAN)
+         TVRDIF[J]=TLVR-T[J]*(1.+R[J]/EPS)/(1.+R[J])
+         #
+   #====== Find maximum level of positive buoyancy, INB
+   #
+   NA=0.0
+   PA=0.0
+   INB=1
+   for J in range(N,JMIN-1,-1) :
+      if TVRDIF[J] > 0 :
+         INB=max(INB,J)
+         #
+   if (INB == JMIN) :
+      return CAPED,TOB,IFLAG,NCT
+      #
+   #====== Find positive and negative areas and CAPE
+   #
+   if (INB > 1) :
+      for J in range((JMIN+1),INB+1) :
+         PFAC=RD*(TVRDIF[J]+TVRDIF[J-1])*(P[J-1]-P[J])/(P[J]+P[J-1])
+         PA=PA+max(PFAC,0.0)
+         NA=NA-min(PFAC,0.0)
+         #
+      PMA=(PP+P[JMIN])
+      PFAC=RD*(PP-P[JMIN])/PMA
+      PA=PA+PFAC*max(TVRDIF[JMIN],0.0)
+      NA=NA-PFAC*min(TVRDIF[JMIN],0.0)
+      #
+      PAT=0.0
+      TOB=T[INB]
+      if (INB < N) :
+         PINB=(P[INB+1]*TVRDIF[INB]-P[INB]*TVRDIF[INB+1])/(TVRDIF[INB]-TVRDIF[INB+1])
+         PAT=RD*TVRDIF[INB]*(P[INB]-PINB)/(P[INB]+PINB)
+         TOB=(T[INB]*(PINB-P[INB+1])+T[INB+1]*(P[INB]-PINB))/(P[INB]-P[INB+1])
+         #
+      CAPED=PA+PAT-NA
+      CAPED=max(CAPED,0.0)
+      #
+   return CAPED,TOB,IFLAG,NCT
+   #
+#-----------------------------------------------------------------------------
+#
+#   pcmin for a single column, T in C and R in g/kg as for pcmin, with the
+#   iteration started from PM0 (mb). Returns PMIN,VMAX,TO,IFL,RAT,CAPEMS,
+#   CAPEM,FAC,CAPEA,PM,NP,NCAPE (CAPE Newton iterations, see
+#   pcmin_fullterm.pcmin_columns); rejected columns and hypercanes only
+#   carry IFL, NP and NCAPE (the other outputs are NaN).
+#
+#-----------------------------------------------------------------------------
+#
+@njit(cache=True)
+def pcmin_kernel(SST,PSL,P,T,R,PM0):
+   #
+   CKCD=0.9
+   SIG=0.0
+   IDISS=1
+   b=2.0
+   NK=0
+   VREDUC=0.8
+   #
+   SSTK=SST+273.15
+   ES0=6.112*np.exp(17.67*SST/(243.5+SST))
+   R=R*0.001
+   T=T+273.15
+   #
+   if not np.isfinite(SST) or (SST <= 5.0) or (np.min(T) <= 100.0) :
+      return np.nan,np.nan,np.nan,0,np.nan,np.nan,np.nan,np.nan,np.nan,np.nan,0,0
+      #
+   IFL=1
+   NP=0
+   PM=PM0
+   PMOLD=PM
+   PNEW=0.0
+   TO=np.nan
+   RAT=np.nan
+   TVAV=np.nan
+   CAPEM=np.nan
+   CAPEMS=np.nan
+   #
+   #   ***   Find environmental CAPE ***
+   #
+   CAPEA,tmp,IFLAG,NIT=cape_kernel(T[NK],R[NK],P[NK],T,R,P,SIG)
+   NCAPE=NIT
+   if (IFLAG != 1) :
+      IFL=2
+      #
+   #   ***   Begin iteration to find mimimum pressure   ***
+   #
+   while (abs(PNEW-PMOLD)) > 0.2 :
+      #
+      TP=T[NK]
+      PP=min(PM,1000.0)
+      RP=0.622*R[NK]*PSL/(PP*(0.622+R[NK])-R[NK]*PSL)
+      CAPEM,TOM,IFLAG,NIT=cape_kernel(TP,RP,PP,T,R,P,SIG)
+      NCAPE=NCAPE+NIT
+      if (IFLAG != 1) :
+         IFL=2
+         #
+      TP=SSTK
+      RP=0.622*ES0/(PP-ES0)
+      CAPEMS,TOMS,IFLAG,NIT=cape_kernel(TP,RP,PP,T,R,P,SIG)
+      NCAPE=NCAPE+NIT
+      TO=TOMS
+      if (IFLAG != 1) :
+         IFL=2
+         #
+      RAT=SSTK/TOMS
+      if (IDISS == 0) :
+         RAT=1.0
+         #
+      RS0=RP
+      TV1=T[0]*(1.+R[0]/0.622)/(1.+R[0])
+      TVAV=0.5*(TV1+SSTK*(1.+RS0/0.622)/(1.+RS0))
+      CAT=CAPEM-CAPEA+0.5*CKCD*RAT*(CAPEMS-CAPEM)
+      CAT=max(CAT,0.0)
+      PNEW=PSL*np.exp(-CAT/(287.04*TVAV))
+      #
+      PMOLD=PM
+      PM=PNEW
+      NP=NP+1
+      #
+      if (NP > 200) or (PM < 400) :
+         return np.nan,np.nan,np.nan,0,np.nan,np.nan,np.nan,np.nan,np.nan,np.nan,NP,NCAPE
+         #
+   CATFAC=0.5*(1.+1./b)
+   CAT=CAPEM-CAPEA+CKCD*RAT*CATFAC*(CAPEMS-CAPEM)
+   CAT=max(CAT,0.0)
+   PMIN=PSL*np.exp(-CAT/(287.04*TVAV))
+   #
+   FAC=max(0.0,(CAPEMS-CAPEM))
+   VMAX=VREDUC*np.sqrt(CKCD*RAT*FAC)
+   #
+   return PMIN,VMAX,TO,IFL,RAT,CAPEMS,CAPEM,FAC,CAPEA,PM,NP,NCAPE
+   #
+#-----------------------------------------------------------------------------
+#
+#   Parallel driver over columns, same call as pcmin_fullterm.pcmin_columns.
+#   It releases the GIL, so create_mpi_map can load the next fields on a
+#   background thread meanwhile.
+#
+#-----------------------------------------------------------------------------
+#
+@njit(parallel=True,cache=True,nogil=True)
+def _pcmin_columns(SST,PSL,P,T,R,PM0):
+   #
+   NCOL=SST.size
+   OUT=np.full((9,NCOL),np.nan)
+   IFL=np.zeros(NCOL,dtype=np.int64)
+   NP=np.zeros(NCOL,dtype=np.int64)
+   NC=np.zeros(NCOL,dtype=np.int64)
+   for i in prange(NCOL) :
+      PMIN,VMAX,TO,IFLi,RAT,CAPEMS,CAPEM,FAC,CAPEA,PM,NPi,NCi=pcmin_kernel(SST[i],PSL[i],P,T[i],R[i],PM0[i])
+      OUT[0,i]=PMIN
+      OUT[1,i]=VMAX
+      OUT[2,i]=TO
+      OUT[3,i]=RAT
+      OUT[4,i]=CAPEMS
+      OUT[5,i]=CAPEM
+      OUT[6,i]=FAC
+      OUT[7,i]=CAPEA
+      OUT[8,i]=PM
+      IFL[i]=IFLi
+      NP[i]=NPi
+      NC[i]=NCi
+   return OUT,IFL,NP,NC
+   #
+def pcmin_columns_jit(SST,PSL,P,T,R,PM0=None,STATS=False):
+   #
+   SST=np.ascontiguousarray(SST,dtype=np.float64)
+   PSL=np.ascontiguousarray(PSL,dtype=np.float64)
+   P=np.ascontiguousarray(P,dtype=np.float64)
+   T=np.ascontiguousarray(T,dtype=np.float64)
+   R=np.ascontiguousarray(R,dtype=np.float64)
+   if PM0 is None :
+      PM0=np.full(SST.size,970.0)
+   PM0=np.broadcast_to(np.asarray(PM0,dtype=np.float64),SST.shape)
+   PM0=np.ascontiguousarray(np.where(np.isfinite(PM0),PM0,970.0))
+   OUT,IFL,NP,NC=_pcmin_columns(SST,PSL,P,T,R,PM0)
+   return(OUT[0],OUT[1],OUT[2],IFL,OUT[3],OUT[4],OUT[5],OUT[6],OUT[7],OUT[8],NP)+((NC,) if STATS else ())
+   #
+#-----------------------------------------------------------------------------
+#
+#   Parity check against the reference implementation
+#
+#-----------------------------------------------------------------------------
+#
+def check_parity(ncol=200,seed=0,rtol=1e-9):
+   #
+   from pcmin_fullterm import pcmin
+   #
+   #   ERA5-like tropical soundings on the 37 ERA5 pressure levels: the
+   #   sounding from the cape.py example extended to the stratosphere and
+   #   randomly warmed/cooled and moistened/dried
+   #
+   P=np.array([1000, 975, 950, 925, 900, 875, 850, 825, 800,
+               775, 750, 700, 650, 600, 550, 500, 450, 400,
+               350, 300, 250, 225, 200, 175, 150, 125, 100,
+               70, 50, 30, 20, 10, 7, 5, 3, 2, 1],dtype='float')
+   PE=np.array([1000, 950, 900, 850, 800, 750, 700, 650, 600, 550, 500,  450,  400,  350,  300,  250,  200,  150,  100,
+                70, 50, 30, 20, 10, 7, 5, 3, 2, 1],dtype='float')
+   TE=np.array([26.0,23.0,19.8,17.3,14.6,11.8, 8.6, 5.1, 1.4,-2.5,-6.9,-11.9,-17.7,-24.8,-33.2,-43.3,-55.2,-61.5,-67.6,
+                -66.0,-61.0,-55.0,-50.0,-42.0,-38.0,-33.0,-28.0,-24.0,-15.0])
+   QE=np.array([17.6,15.3,13.0,11.0, 8.4, 7.1, 5.8, 4.6, 3.6, 3.2, 2.1,  1.4,    0,    0,    0,    0,    0,    0,    0,
+                0,0,0,0,0,0,0,0,0,0])
+   T0=np.interp(np.log(P),np.log(PE[::-1]),TE[::-1])
+   Q0=np.interp(np.log(P),np.log(PE[::-1]),QE[::-1])
+   #
+   rng=np.random.default_rng(seed)
+   T=T0[None,:]+rng.uniform(-4.0,4.0,(ncol,1))+rng.normal(0.0,0.3,(ncol,P.size))
+   Q=Q0[None,:]*rng.uniform(0.6,1.2,(ncol,1))
+   SST=T[:,0]+rng.uniform(-1.0,2.0,ncol)
+   PSL=rng.uniform(1005.0,1018.0,ncol)
+   #
+   OUT=pcmin_columns_jit(SST,PSL,P,T,Q)
+   NBAD=0
+   for i in range(ncol) :
+      REF=pcmin(SST[i],PSL[i],P,T[i],Q[i])
+      for k in range(len(REF)) :
+         if not np.allclose(OUT[k][i],REF[k],rtol=rtol,atol=0.0,equal_nan=True) :
+            NBAD=NBAD+1
+            #
+   print("pcmin_jit parity: %i of %i columns checked, %i mismatches (numba: %s)" % (ncol,ncol,NBAD,HAS_NUMBA))
+   return NBAD == 0
+   #
+if __name__ == "__main__":
+   check_parity()
@@ -18,6 +18,7 @@ from datetime import date, timedelta
 from scipy import stats
 import os
 import sys
+from track_store import save_tracks, load_tracks, INTERPOLATED_BITS
 dir_path=os.path.dirname(os.path.realpath(sys.argv[0]))
 __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
 
@@ -105,20 +106,73 @@ def interpolate(dataset):
     
     return dataset
         
-def check_timelist(tlist):
+def interpolate_ragged(values,offsets=None):
     """
-    Check whether the consecutive time steps are 3 hours apart
+    Interpolate the gaps of many datasets at once, as interpolate does for one dataset: 
+    missing values between the first and the last known value are interpolated linearly, 
+    leading and trailing missing values are left untouched
     Input:
-        tlist: list of time steps
+        values: ragged array (..., points) with offsets, the leading axes are separate
+                variables with the same offsets (e.g. lat, lon, wind), or a padded array
+                (..., time) without offsets, where every row is one dataset
+        offsets: offsets of the ragged array, dataset k is values[...,offsets[k]:offsets[k+1]]
     Output:
-        print tlist if the consecutive time steps are not 3 hours apart
+        values: the interpolated values, same shape
+    """
+    values=np.array(values,dtype=np.float64)
+    n=values.shape[-1]
+    rows=values.size//max(n,1)
+    if offsets is None:
+        offsets=np.arange(0,values.size+1,max(n,1))
+    else:
+        offsets=np.asarray(offsets)
+        offsets=np.concatenate([(offsets[:-1]+r*n) for r in range(rows)]+[[values.size]])
+    
+    flat=values.reshape(-1)
+    known=np.flatnonzero(~np.isnan(flat))
+    if len(known)<2:
+        return values
+    
+    #first and last known value of the dataset of every point
+    pos=np.arange(flat.size)
+    seg=np.searchsorted(offsets,pos,side='right')-1
+    k0=np.searchsorted(known,offsets[:-1])
+    k1=np.searchsorted(known,offsets[1:])-1
+    first=known[np.minimum(k0,len(known)-1)][seg]
+    last=known[np.maximum(k1,0)][seg]
     
+    gaps=np.isnan(flat) & (pos>first) & (pos<last) & (k1>=k0)[seg]
+    flat[gaps]=np.interp(pos[gaps],known,flat[known])
+    return values
+
+def typed_values(tracks,offsets):
+    """
+    The point values as in the dictionaries of the original code: the IBTrACS values in float32 and 
+    the interpolated values in float64
+    Input:
+        tracks: track store (see extract_data)
+        offsets: offsets of the point values
+    Output:
+        values: dict {variable: float64 array of the values}
+        is32: dict {variable: boolean array, True where the original value is float32}
     """
+    is32={var:(tracks['interpolated']>>k & 1)==0 for k,var in enumerate(TRACK_VARIABLES)}
+    interp=interpolate_ragged(np.stack([np.where(is32[var],tracks[var],np.nan) for var in TRACK_VARIABLES]),offsets)
+    return dict(zip(TRACK_VARIABLES,interp)),is32
+
+def typed_diff(values,is32,i,j):
+    """
+    values[i]-values[j] in float32 when both values are float32, in float64 otherwise (as the original code)
+    Output:
+        difference (float64 array) and whether it is float32
+    """
+    both=is32[i] & is32[j]
+    return np.where(both,values[i].astype(np.float32)-values[j].astype(np.float32),values[i]-values[j]),both
+
+def typed_array(values,is32):
+    #the array numpy makes of a list of such values: float32 if all of them are float32
+    return values.astype(np.float32) if np.all(is32) else values
 
-    for ii in range(1,len(tlist)):
-        if tlist[ii]-tlist[ii-1]!=0.125:
-            print(tlist)
-            
 def convert_wind_speed(wind,agency):
     """
     Convert IBTrACS wind speed to 10-min sustained wind speed. 
@@ -147,23 +201,62 @@ def convert_wind_speed(wind,agency):
         
     return wind_conv   
 
+ONE_MINUTE_AGENCIES=[b'hurdat_epa',b'hurdat_atl',b'newdelhi',b'atcf']
+
+BASIN_CODES={b'EP':0,b'NA':1,b'NI':2,b'SI':3,b'SP':4,b'WP':5}
+
+TRACK_VARIABLES=INTERPOLATED_BITS
+
+def first_true(mask):
+    """
+    Column index of the first True in every row of a 2-D boolean array (0 if there is none)
+    """
+    return np.argmax(mask,axis=1)
+
+def last_true(mask):
+    """
+    Column index of the last True in every row of a 2-D boolean array (-1 if there is none)
+    """
+    return np.where(mask.any(axis=1),mask.shape[1]-1-np.argmax(mask[:,::-1],axis=1),-1)
+
+def ragged_offsets(counts):
+    """
+    Offsets of ragged arrays: the values of entry k are values[offsets[k]:offsets[k+1]]
+    """
+    return np.concatenate([[0],np.cumsum(counts)]).astype(np.int64)
+
+def ragged_to_dict(values,offsets,storms,nstorms):
+    """
+    Convert a ragged array back to the dictionary of lists used in the original STORM files
+    Input:
+        values,offsets: ragged array
+        storms: IBTrACS storm index of every entry
+        nstorms: number of storms in the IBTrACS dataset
+    Output:
+        dictionary {storm: list of values}, empty lists for the storms that are not selected
+    """
+    out={i:[] for i in range(nstorms)}
+    for k,i in enumerate(storms):
+        out[i]=list(values[offsets[k]:offsets[k+1]])
+    return out
+
 def extract_data(data):
     """
     Extract different variables from IBTrACS dataset.
     Input:
         *data*: dataset (IBTrACS)
     Output: 
-        *LATLIST_INTERP.npy*: interpolated values of latitude, where each entry in the dictionary stands for one TC
-        *LONLIST_INTERP.npy*: interpolated values of longitude (0-360 deg)
-        *WINDLIST_INTERP.npy*: interpolated values of wind (m/s)
-        *PRESLIST_INTERP.npy*: interpolated values of pressure (hPa)
-        *RMAXLIST_INTERP.npy*: interpolated values of Rmax (km)
-        *MONTHLIST_INTERP.npy*: Month of TC genesis
-        *BASINLIST_INTERP.npy*: Basin of TC genesis
-        *YEARLIST_INTERP.npy*: Year of TC genesis
+        *TRACKS_INTERP*: track store (see track_store.py) of the selected TCs, with
+            storm: index of the TC in the IBTrACS dataset
+            month, basin, year: month, basin (-1 if not one of the six basins) and year of TC genesis
+            lat, lon, wind, pres, rmax: interpolated values of latitude, longitude (0-360 deg), 
+                wind (m/s), pressure (hPa) and Rmax (km), TC k is in lat[offsets[k]:offsets[k+1]]
+            time: time steps (days since 17-11-1858), TC k is in time[time_offsets[k]:time_offsets[k+1]]
+            interpolated: bit k is set where TRACK_VARIABLES[k] was interpolated
+        The values are float32 as in IBTrACS and the same as in the dictionaries of the original STORM code 
+        (see ragged_to_dict), except the interpolated ones, which are float64 there (see typed_values). 
     """
     
-    basin=data.basin.values
     years=data.season.values
     wind=data.wmo_wind.values
     wind=wind*0.51444444    #convert from knots to m/s
@@ -172,224 +265,196 @@ def extract_data(data):
     latitude=data.lat.values
     longitude=data.lon.values
     rmax=data.usa_rmw.values*1.85200 #convert from nm to km    
-    wmo_agency=data.wmo_agency.values    
-    nature=data.nature.values
-    
-    """Create a npy list for each of the items"""    
-    latlist={i:[] for i in range(len(years))}
-    lonlist={i:[] for i in range(len(years))}
-    timelist={i:[] for i in range(len(years))}
-    windlist={i:[] for i in range(len(years))}
-    preslist={i:[] for i in range(len(years))}
-    monthlist={i:[] for i in range(len(years))}
-    basinlist={i:[] for i in range(len(years))}
-    rmaxlist={i:[] for i in range(len(years))}
-    yearlist={i:[] for i in range(len(years))}    
-    
-    for i in range(len(years)):
-        if years[i]<2018:            
-            idx=[x for x,v in enumerate(wmo_agency[i]) if len(v)>1.]            
-            if len(idx)>0: #there is data on wind speed and associated agency. 
-                #Note that if the wind list solely consists of 'nan',there would be no associated agency. 
-                #And that if there is a wind reading, there is also an associated agency.                
-                wind_conv=convert_wind_speed(wind[i],wmo_agency[i][idx[0]].decode("utf-8"))
-                    
-                if np.all(np.isnan(wind_conv))==False and np.nanmax(wind_conv)>=18.:
-                    
-                    """We consider the timesteps between the first and the last moment of maximum wind speed > 18 m/s (equal to a tropical storm)"""  
-                    ind=[x for x,v in enumerate(wind_conv) if v>=18.]    
-                    nature_list=[x.decode("utf-8") for x in nature[i]]
-                    
-                    if 'ET' in nature_list:
-                        et_idx=nature_list.index('ET')
-                        
-                        if et_idx>ind[0]:
-                            end=max(ii for ii in ind if ii<et_idx)
-                            ind=ind[:end+1]
-                        else:
-                            ind=[]
-                        
-                    if len(ind)>0. and basin[i][ind[0]].decode("utf-8")!='SA': #exclude the south atlantic                    
-                        j0=ind[0] #first location at which storm is tropical storm                        
-                        if len(ind)>1: #the storm spans multiple time steps               
-                            j1=ind[-1] #last location at which storm is tropical storm                                              
-                        else:
-                            j0=ind[0]
-                            j1=j0                        
-                        
-                        monthlist[i].append(find_month(time[i][ind[0]]))
-                        basinlist[i].append(find_basin(basin[i][ind[0]].decode("utf-8")))
-                        yearlist[i].append(years[i])
-                        
-                        idx=[x for x,v in enumerate(wmo_agency[i]) if len(v)>1.]                        
-                        time_idx=[j0+x for x,v in enumerate(time[i][j0:j1+1]) if round(v,3)%0.125==0.]                         
-                        new_list=np.intersect1d(ind,time_idx)
-             
-                        if len(new_list)>1.:
-                            n0=time_idx.index(new_list[0])
-                            n1=time_idx.index(new_list[-1])
-                           
-                            new_time=time_idx[n0:n1+1]
-                            
-                            j_idx=0
-                            while j_idx<len(new_time):                                
-                                j=new_time[j_idx]        
-                                latlist[i].append(latitude[i][j])
-                                
-                                if longitude[i][j]<0.:
-                                    longitude[i][j]+=360.
-                                
-                                lonlist[i].append(longitude[i][j])
-                                timelist[i].append(round(time[i][j],3))        
-                                windlist[i].append(wind_conv[j])                                
-                                preslist[i].append(pres[i][j])
-                                rmaxlist[i].append(rmax[i][j])
-                                j_idx=j_idx+1        
-                            
-                            check_timelist(timelist[i])                    
-                         
-    """This part is for interpolating the missing values"""
-    lat_int={i:[] for i in range(len(years))}
-    lon_int={i:[] for i in range(len(years))}    
-    wind_int={i:[] for i in range(len(years))}
-    pres_int={i:[] for i in range(len(years))}    
-    rmax_int={i:[] for i in range(len(years))}    
-    
-    for i in range(len(latlist)):
-        if len(latlist[i])>0:
-            if np.isnan(windlist[i][-1])==True:      
-                lat_int[i]=interpolate(latlist[i][:-1])
-                lon_int[i]=interpolate(lonlist[i][:-1])                
-                wind_int[i]=interpolate(windlist[i][:-1])
-                pres_int[i]=interpolate(preslist[i][:-1])        
-                rmax_int[i]=interpolate(rmaxlist[i][:-1])
-            else:
-                lat_int[i]=interpolate(latlist[i])
-                lon_int[i]=interpolate(lonlist[i])                
-                wind_int[i]=interpolate(windlist[i])
-                pres_int[i]=interpolate(preslist[i])        
-                rmax_int[i]=interpolate(rmaxlist[i])
-            
+    basin=data.basin.values.astype(bytes)
+    wmo_agency=data.wmo_agency.values.astype(bytes)
+    nature=data.nature.values.astype(bytes)
+    
+    nstorms,ntime=wind.shape
+    storms=np.arange(nstorms)
+    col=np.arange(ntime)[None,:]
+    
+    """The agency is the first entry with a name, the wind of 1-minute agencies is converted to 10-minute wind"""
+    has_agency=np.char.str_len(wmo_agency)>1
+    agency=wmo_agency[storms,first_true(has_agency)]
+    wind_conv=np.where(np.isin(agency,ONE_MINUTE_AGENCIES)[:,None],convert_wind_speed(wind,'atcf'),wind)
+    
+    """We consider the timesteps between the first and the last moment of maximum wind speed > 18 m/s (equal to a tropical storm)"""  
+    ind=wind_conv>=18.
+    select=(years<2018) & has_agency.any(axis=1) & ind.any(axis=1)
+    
+    """Storms are cut before extratropical transition (ET). As in the original code, only the first end+1 of these 
+    time steps are kept, where end is the last time step before ET."""
+    is_et=nature==b'ET'
+    et_idx=np.where(is_et.any(axis=1),first_true(is_et),ntime)
+    end=last_true(ind & (col<et_idx[:,None]))
+    ind=ind & (np.cumsum(ind,axis=1)<=end[:,None]+1)
+    
+    j0=first_true(ind)
+    j1=last_true(ind)
+    select&=ind.any(axis=1) & (basin[storms,j0]!=b'SA') #exclude the south atlantic
+    
+    """Keep the 3-hourly time steps between the first and the last 3-hourly time step of tropical storm strength"""
+    time_3h=(np.round(time,3)%0.125==0.) & (col>=j0[:,None]) & (col<=j1[:,None])
+    new_list=ind & time_3h
+    keep=time_3h & (col>=first_true(new_list)[:,None]) & (col<=last_true(new_list)[:,None])
+    keep[~select | (new_list.sum(axis=1)<=1)]=False
+    
+    storms=storms[select]
+    keep=keep[select]
+    counts=keep.sum(axis=1)
+    time_offsets=ragged_offsets(counts)
+    
+    tracks={'storm':storms,
+            'month':np.array([find_month(t) for t in time[storms,j0[storms]]],dtype=np.int64),
+            'basin':np.array([BASIN_CODES.get(b,-1) for b in basin[storms,j0[storms]]],dtype=np.int64),
+            'year':years[storms].astype(np.int64),
+            'time':np.round(time[storms][keep],3),
+            'time_offsets':time_offsets}
+    
+    lon=longitude[storms][keep]
+    values={'lat':latitude[storms][keep],
+            'lon':np.where(lon<0.,lon+360.,lon),
+            'wind':wind_conv[storms][keep],
+            'pres':pres[storms][keep],
+            'rmax':rmax[storms][keep]}
+    
+    """The last time step is dropped (except from time) when its wind speed is missing"""
+    last=time_offsets[1:]-1
+    drop=np.zeros(len(storms),dtype=bool)
+    drop[counts>0]=np.isnan(values['wind'][last[counts>0]])
+    point=np.ones(time_offsets[-1],dtype=bool)
+    point[last[drop]]=False
+    counts=counts-drop
+    
+    """Time steps in between that are not 3 hours apart"""
+    dt=np.diff(tracks['time'])!=0.125
+    bounds=time_offsets[1:-1]
+    dt[bounds[(bounds>0) & (bounds<len(tracks['time']))]-1]=False #steps between two TCs
+    if np.any(dt):
+        print(str(len(np.unique(np.searchsorted(time_offsets,np.flatnonzero(dt),side='right'))))+' TCs have time steps that are not 3 hours apart')
+    
+    """This part is for interpolating the missing values. The values keep the float32 of IBTrACS, the interpolated 
+    ones are flagged (bit k of interpolated for TRACK_VARIABLES[k]), so that TC_variables can redo them in float64 
+    as the original code"""
+    offsets=ragged_offsets(counts)
+    tracks['offsets']=offsets
+    raw=np.stack([values[var][point] for var in TRACK_VARIABLES])
+    interp=interpolate_ragged(raw,offsets)
+    tracks['interpolated']=np.zeros(offsets[-1],dtype=np.uint8)
+    for k,(var,r,v) in enumerate(zip(TRACK_VARIABLES,raw,interp)):
+        tracks[var]=v.astype(r.dtype)
+        tracks['interpolated']|=(np.isnan(r) & ~np.isnan(v)).astype(np.uint8)<<k
+                
     """
-    Save the interpolated datasets as .npy files. These files will be used later on 
-    and also come in handy when plotting IBTrACS data
+    Save the interpolated datasets as a track store. This will be used later on 
+    and also comes in handy when plotting IBTrACS data
     """       
-    np.save(os.path.join(dir_path,'LATLIST_INTERP.npy'),lat_int)
-    np.save(os.path.join(dir_path,'LONLIST_INTERP.npy'),lon_int)
-    np.save(os.path.join(dir_path,'TIMELIST_INTERP.npy'),timelist)
-    np.save(os.path.join(dir_path,'WINDLIST_INTERP.npy'),wind_int)
-    np.save(os.path.join(dir_path,'PRESLIST_INTERP.npy'),pres_int)
-    np.save(os.path.join(dir_path,'RMAXLIST_INTERP.npy'),rmax_int)
-    np.save(os.path.join(dir_path,'MONTHLIST_INTERP.npy'),monthlist)
-    np.save(os.path.join(dir_path,'BASINLIST_INTERP.npy'),basinlist)
-    np.save(os.path.join(dir_path,'YEARLIST_INTERP.npy'),yearlist)
+    save_tracks(os.path.join(dir_path,'TRACKS_INTERP'),tracks,nstorms)
 
 def TC_variables():
     """
     Extract the important variables. 
     """
     try:
-        latlist=np.load(os.path.join(__location__,'LATLIST_INTERP.npy'),allow_pickle=True).item()
-        lonlist=np.load(os.path.join(__location__,'LONLIST_INTERP.npy'),allow_pickle=True).item()
-        windlist=np.load(os.path.join(__location__,'WINDLIST_INTERP.npy'),allow_pickle=True).item()
-        preslist=np.load(os.path.join(__location__,'PRESLIST_INTERP.npy'),allow_pickle=True).item()
-        rmaxlist=np.load(os.path.join(__location__,'RMAXLIST_INTERP.npy'),allow_pickle=True).item()
-        monthlist=np.load(os.path.join(__location__,'MONTHLIST_INTERP.npy'),allow_pickle=True).item()
-        basinlist=np.load(os.path.join(__location__,'BASINLIST_INTERP.npy'),allow_pickle=True).item()
+        tracks=load_tracks(os.path.join(__location__,'TRACKS_INTERP'),mmap=False)
     except FileNotFoundError:
         print('Files do not exist in '+str(__location__)+', please check directory')
         return 
     
+    offsets=tracks['offsets']
+    values,is32=typed_values(tracks,offsets)
+    lat,lon,wind,pres,rmax=[values[var] for var in TRACK_VARIABLES]
+    counts=np.diff(offsets)
+    
     monthsall=[[6,7,8,9,10,11],[6,7,8,9,10,11],[4,5,6,9,10,11],[1,2,3,4,11,12],[1,2,3,4,11,12],[5,6,7,8,9,10,11]]
-   
-    months={i:[] for i in range(0,6)}
-    genesis_wind={i:[] for i in range(0,6)}
-    genesis_pressure={i:[] for i in range(0,6)}
-    genesis_dpres={i:[] for i in range(0,6)}
-    genesis_pres_var={i:[] for i in range(0,6)}    
-    genesis_loc={i:[] for i in range(0,6)}
-    poisson={i:[0] for i in range(0,6)}    #Poisson genesis parameters (avg number of TC formations per year)
-    genesis_poisson=[] 
-    
-    track={i:[] for i in range(0,6)}     #All info for the track. 
+    
+    """TCs with time steps, formed in one of the six basins in one of the months of that basin"""
+    basin=tracks['basin']
+    month=tracks['month']
+    tc=np.flatnonzero((counts>0) & (basin>=0))
+    tc=tc[[m in monthsall[b] for b,m in zip(basin[tc],month[tc])]]
+    tc_basin=basin[tc]
+    tc_month=month[tc]
+    
+    """Genesis variables, the first time step of every TC"""
+    g0=offsets[tc]
+    g1=np.where(counts[tc]>1,g0+1,g0)
+    gen_wind=wind[g0]
+    gen_pressure=pres[g0]
+    gen_dpres,gen_dpres32=typed_diff(pres,is32['pres'],g1,g0)
+    gen_dpres=np.where(counts[tc]>1,gen_dpres,np.nan)
+    
+    """Points with a previous and a next time step, in the order of the TCs"""
+    tc_of_point=np.repeat(np.arange(len(counts)),counts)
+    point=np.flatnonzero(np.isin(tc_of_point,tc))
+    point=point[(point>offsets[tc_of_point[point]]) & (point<offsets[tc_of_point[point]+1]-1)]
+    point_basin=basin[tc_of_point[point]]
+    point_month=month[tc_of_point[point]]
+    
+    dlat0,dlat1=typed_diff(lat,is32['lat'],point,point-1),typed_diff(lat,is32['lat'],point+1,point)
+    dlon0,dlon1=typed_diff(lon,is32['lon'],point,point-1),typed_diff(lon,is32['lon'],point+1,point)
+    dp0,dp1=typed_diff(pres,is32['pres'],point,point-1),typed_diff(pres,is32['pres'],point+1,point)
+    point_lat,point_lon,point_pres=[(v[point],is32[var][point]) for v,var in [(lat,'lat'),(lon,'lon'),(pres,'pres')]]
+    valid_p=~np.isnan(pres[point-1]) & ~np.isnan(pres[point]) & ~np.isnan(pres[point+1])
+    
+    months={}
+    genesis_wind={}
+    genesis_pressure={}
+    genesis_dpres={}
+    genesis_pres_var={}
+    genesis_loc={}
+    genesis_poisson=[]    #Poisson genesis parameters (avg number of TC formations per year)
+    
+    track={i:{} for i in range(0,6)}     #All info for the track. 
     #0=dlat0 (backward change in latitude),1=dlat1 (forward change in latitude),2=dlon0,3=dlon1,4=lat,5=lon
-    pressure={i:[] for i in range(0,6)}     #All info for the pressure change
+    pressure={i:{} for i in range(0,6)}     #All info for the pressure change
     #0=dp0 (backward change in pressure), 1=dp1 (forward change in pressure), 2=pressure, 3=latitude, 4=longitude, 5=month
-    for i in range(0,6): #for basins?
-        track[i]={j:[] for j in range(0,6)}
-        pressure[i]={j:[] for j in range(0,6)}
-        
+    
     for idx in range(0,6):
-        genesis_wind[idx]={i:[] for i in monthsall[idx]}        #genesis wind speed
-        genesis_pressure[idx]={i:[] for i in monthsall[idx]}    #genesis pressure
-        genesis_dpres[idx]={i:[] for i in monthsall[idx]}       #genesis change in pressure
-        genesis_pres_var[idx]={i:[] for i in monthsall[idx]}    #genesis variables for pressure.
-        genesis_loc[idx]={i:[] for i in monthsall[idx]}         #genesis location
+        in_basin=tc_basin==idx
+        months[idx]=tc_month[in_basin].tolist()
+        genesis_poisson.append(round(int(np.sum(in_basin))/38.,1))
         
-    for i in range(len(latlist)):
-        if len(latlist[i])>0:
-            idx=basinlist[i][0]     #this is the index for each of the basins. 0=EP, 1=NA, 2=NI, 3=SI, 4=SP, 5=WP
-            month=monthlist[i][0]   #genesis month
-            
-            if month in monthsall[idx]:
-                months[idx].append(month)
-                genesis_wind[idx][month].append(windlist[i][0])
-                genesis_dpres[idx][month].append(preslist[i][1]-preslist[i][0])
-                genesis_pressure[idx][month].append(preslist[i][0])
-                genesis_loc[idx][month].append([latlist[i][0],lonlist[i][0]])
-                poisson[idx][0]+=1
-                
-                for j in range(1,len(latlist[i])-1):
-                    track[0][idx].append(latlist[i][j]-latlist[i][j-1])
-                    track[1][idx].append(latlist[i][j+1]-latlist[i][j])
-                    track[2][idx].append(lonlist[i][j]-lonlist[i][j-1])
-                    track[3][idx].append(lonlist[i][j+1]-lonlist[i][j])
-                    track[4][idx].append(latlist[i][j])
-                    track[5][idx].append(lonlist[i][j])
-                
-                for j in range(1,len(preslist[i])-1):
-                    if np.isnan(preslist[i][j-1])==False and np.isnan(preslist[i][j])==False and np.isnan(preslist[i][j+1])==False:
-                        pressure[0][idx].append(preslist[i][j]-preslist[i][j-1])
-                        pressure[1][idx].append(preslist[i][j+1]-preslist[i][j])
-                        pressure[2][idx].append(preslist[i][j])
-                        pressure[3][idx].append(latlist[i][j])
-                        pressure[4][idx].append(lonlist[i][j])
-                        pressure[5][idx].append(month)
-                 
-    for idx in range(0,6):
-        genesis_poisson.append(round(poisson[idx][0]/38.,1))
+        b=point_basin==idx
+        for j,(v,v32) in enumerate([dlat0,dlat1,dlon0,dlon1,point_lat,point_lon]):
+            track[j][idx]=typed_array(v[b],v32[b])
         
-        dp0_neg,dp0_pos=[],[]
-        for j in range(len(pressure[0][idx])):
-            if pressure[0][idx][j]<0.:
-                dp0_neg.append(pressure[0][idx][j])
-            elif pressure[0][idx][j]>0:
-                dp0_pos.append(pressure[0][idx][j])
+        b&=valid_p
+        for j,(v,v32) in enumerate([dp0,dp1,point_pres,point_lat,point_lon]):
+            pressure[j][idx]=typed_array(v[b],v32[b])
+        pressure[5][idx]=point_month[b].tolist()
         
-        pneg=np.percentile(dp0_neg,1)
-        ppos=np.percentile(dp0_pos,99)
+        dp0_basin,dp0_32_basin=dp0[0][b],dp0[1][b]
+        pneg=np.percentile(typed_array(dp0_basin[dp0_basin<0.],dp0_32_basin[dp0_basin<0.]),1)
+        ppos=np.percentile(typed_array(dp0_basin[dp0_basin>0.],dp0_32_basin[dp0_basin>0.]),99)
         
-        for month in monthsall[idx]:
-            dplist=[v for v in genesis_dpres[idx][month] if np.isnan(v)==False and v>-1000.]
-            plist=[v for v in genesis_pressure[idx][month] if np.isnan(v)==False and v>0.]
+        genesis_wind[idx]={}
+        genesis_pressure[idx]={}
+        genesis_dpres[idx]={}
+        genesis_pres_var[idx]={}
+        genesis_loc[idx]={}
+        for m in monthsall[idx]:
+            g=in_basin & (tc_month==m)
+            genesis_wind[idx][m]=typed_array(gen_wind[g],is32['wind'][g0[g]])
+            genesis_dpres[idx][m]=typed_array(gen_dpres[g],gen_dpres32[g])
+            genesis_pressure[idx][m]=typed_array(gen_pressure[g],is32['pres'][g0[g]])
+            genesis_loc[idx][m]=typed_array(np.stack([lat[g0[g]],lon[g0[g]]],axis=1),
+                                            np.stack([is32['lat'][g0[g]],is32['lon'][g0[g]]],axis=1))
+            
+            dp_valid=~np.isnan(gen_dpres[g]) & (gen_dpres[g]>-1000.)
+            p_valid=~np.isnan(gen_pressure[g]) & (gen_pressure[g]>0.)
+            dplist=typed_array(gen_dpres[g][dp_valid],gen_dpres32[g][dp_valid])
+            plist=typed_array(gen_pressure[g][p_valid],is32['pres'][g0[g]][p_valid])
             
             mudp0,stddp0=stats.norm.fit(dplist)
             mupres,stdpres=stats.norm.fit(plist)
             
-            genesis_pres_var[idx][month]=[mupres,stdpres,mudp0,stddp0,pneg,ppos]
-            
-                
-    radius={i:[] for i in range(0,3)}
-    for i in range(len(rmaxlist)):
-        if len(rmaxlist[i])>0.:
-            for j in range(len(rmaxlist[i])):
-                if np.isnan(rmaxlist[i][j])==False and np.isnan(preslist[i][j])==False:                    
-                    if preslist[i][j]<=920.:
-                        radius[0].append(rmaxlist[i][j])
-                    elif preslist[i][j]>920. and preslist[i][j]<=960.:
-                        radius[1].append(rmaxlist[i][j])
-                    elif preslist[i][j]>960.:
-                        radius[2].append(rmaxlist[i][j])               
+            genesis_pres_var[idx][m]=[mupres,stdpres,mudp0,stddp0,pneg,ppos]
+    
+    """Rmax of all time steps in three pressure bins: <=920, 920-960 and >960 hPa"""
+    valid_r=~np.isnan(rmax) & ~np.isnan(pres)
+    bins=np.digitize(pres[valid_r],[920.,960.],right=True)
+    radius={i:typed_array(rmax[valid_r][bins==i],is32['rmax'][valid_r][bins==i]) for i in range(0,3)}
      
     print(genesis_poisson)
     np.save(os.path.join(__location__,'RMAX_PRESSURE.npy'),radius)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Columnar storage of the IBTrACS tracks selected by preprocessing.extract_data.
+
+A track store is a directory with one .npy file per column and a meta.json:
+    point columns: lat, lon, wind, pres, rmax, interpolated (with offsets) and
+                   time (with time_offsets), the values of all TCs one after the
+                   other, TC k is in lat[offsets[k]:offsets[k+1]]; bit k of
+                   interpolated is set where INTERPOLATED_BITS[k] was interpolated
+    TC columns:    storm (index in the IBTrACS dataset), month, basin, year
+The columns are plain arrays, so they are memory-mapped instead of unpickled,
+and the TCs of one basin can be read without loading the other basins.
+"""
+
+import numpy as np
+import os
+import json
+
+POINT_COLUMNS = {'lat': 'offsets', 'lon': 'offsets', 'wind': 'offsets',
+                 'pres': 'offsets', 'rmax': 'offsets', 'interpolated': 'offsets',
+                 'time': 'time_offsets'}
+
+INTERPOLATED_BITS = ['lat', 'lon', 'wind', 'pres', 'rmax']
+
+TC_COLUMNS = ['storm', 'month', 'basin', 'year']
+
+OFFSET_COLUMNS = ['offsets', 'time_offsets']
+
+PICKLE_FILES = {'lat': 'LATLIST', 'lon': 'LONLIST', 'wind': 'WINDLIST', 'pres': 'PRESLIST',
+                'rmax': 'RMAXLIST', 'time': 'TIMELIST', 'month': 'MONTHLIST',
+                'basin': 'BASINLIST', 'year': 'YEARLIST'}
+
+def column_path(path, name):
+    return os.path.join(path, name + '.npy')
+
+def save_tracks(path, tracks, nstorms):
+    """
+    Write a track store
+    Input:
+        path: directory of the store
+        tracks: dictionary with all point, TC and offset columns
+        nstorms: number of storms in the IBTrACS dataset
+    """
+    os.makedirs(path, exist_ok=True)
+    # an existing store is invalidated first, so an interrupted overwrite does not
+    # leave old and new columns that load as one store
+    if os.path.exists(os.path.join(path, 'meta.json')):
+        os.remove(os.path.join(path, 'meta.json'))
+    for name in list(POINT_COLUMNS) + TC_COLUMNS + OFFSET_COLUMNS:
+        tmp = column_path(path, name + '.' + str(os.getpid()) + '.tmp')
+        np.save(tmp, np.ascontiguousarray(tracks[name]))
+        os.replace(tmp, column_path(path, name))
+
+    # meta.json is written last, so an interrupted write is not taken for a store
+    meta = {'nstorms': int(nstorms), 'ntc': len(tracks['storm']),
+            'point_columns': POINT_COLUMNS, 'tc_columns': TC_COLUMNS,
+            'basins': {str(b): int(np.sum(tracks['basin'] == b)) for b in np.unique(tracks['basin'])}}
+    tmp = os.path.join(path, 'meta.' + str(os.getpid()) + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(meta, f, indent=1)
+    os.replace(tmp, os.path.join(path, 'meta.json'))
+
+def load_meta(path):
+    with open(os.path.join(path, 'meta.json')) as f:
+        return json.load(f)
+
+def ragged_take(values, offsets, sel):
+    """
+    Entries sel of a ragged array
+    Input:
+        values,offsets: ragged array
+        sel: indices of the entries
+    Output:
+        values,offsets: ragged array of the selected entries
+    """
+    counts = np.diff(offsets)[sel]
+    new_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    points = np.repeat(offsets[sel] - new_offsets[:-1], counts) + np.arange(new_offsets[-1])
+    return values[points], new_offsets
+
+def load_tracks(path, basin = None, mmap = True):
+    """
+    Read a track store
+    Input:
+        path: directory of the store
+        basin: basin index (0-5) to read only the TCs of one basin, None for all
+        mmap: memory-map the columns instead of reading them
+    Output:
+        tracks: dictionary of the point, TC and offset columns (read-only memmaps when
+                mmap and basin is None)
+    """
+    # a store without meta.json is incomplete (FileNotFoundError)
+    load_meta(path)
+    mode = 'r' if mmap else None
+    tracks = {name: np.load(column_path(path, name), mmap_mode=mode)
+              for name in list(POINT_COLUMNS) + TC_COLUMNS + OFFSET_COLUMNS}
+    if basin is None:
+        return tracks
+
+    sel = np.flatnonzero(tracks['basin'] == basin)
+    part = {name: np.asarray(tracks[name][sel]) for name in TC_COLUMNS}
+    for offsets in OFFSET_COLUMNS:
+        for name in [n for n in POINT_COLUMNS if POINT_COLUMNS[n] == offsets]:
+            part[name], part[offsets] = ragged_take(tracks[name], tracks[offsets], sel)
+    return part
+
+def convert_pickles(src, path):
+    """
+    Convert the pickled dictionaries of the original extract_data (LATLIST_INTERP.npy, ...)
+    in directory src to a track store in directory path
+    """
+    lists = {name: np.load(os.path.join(src, PICKLE_FILES[name] + '_INTERP.npy'), allow_pickle=True).item()
+             for name in PICKLE_FILES}
+    nstorms = len(lists['month'])
+
+    # every TC that has a genesis month, also the ones without any time step
+    storms = np.array([i for i in range(nstorms) if len(lists['month'][i]) > 0], dtype=np.int64)
+    tracks = {'storm': storms,
+              'month': np.array([lists['month'][i][0] for i in storms], dtype=np.int64),
+              'basin': np.array([-1 if lists['basin'][i][0] is None else lists['basin'][i][0] for i in storms], dtype=np.int64),
+              'year': np.array([lists['year'][i][0] for i in storms], dtype=np.int64)}
+    for name in PICKLE_FILES:
+        if name not in POINT_COLUMNS:
+            continue
+        counts = [len(lists[name][i]) for i in storms]
+        tracks[POINT_COLUMNS[name]] = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        tracks[name] = np.array([v for i in storms for v in lists[name][i]], dtype=np.float64)
+
+    # the lists hold the float32 IBTrACS values and the float64 interpolated values
+    tracks['interpolated'] = np.zeros(tracks['offsets'][-1], dtype=np.uint8)
+    for k, name in enumerate(INTERPOLATED_BITS):
+        interpolated = [not isinstance(v, np.float32) for i in storms for v in lists[name][i]]
+        tracks['interpolated'] |= np.array(interpolated, dtype=np.uint8) << k
+        tracks[name] = tracks[name].astype(np.float32)
+
+    save_tracks(path, tracks, nstorms)
+    return path